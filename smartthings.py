@@ -3,9 +3,22 @@ from my_secrets.secrets import ST_WEBHOOK, PA_TOKEN
 
 #HTTP Libs
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import ConnectTimeoutError
+from urllib.parse import urlsplit
+import random
+
+#eventlet Libs
+import eventlet
+from eventlet.queue import LightQueue
+from greenlet import GreenletExit
 
 #JSON Libs
 import json
+import copy
+
+#collections Libs
+from collections import deque
 
 #sqlite3 Libs
 import sqlite3
@@ -13,13 +26,53 @@ import sqlite3
 #os Libs
 from os.path import exists
 
+#contextlib Libs
+from contextlib import contextmanager
+
+#threading Libs
+import threading
+
+#atexit Libs
+import atexit
+
 #datetime Libs
 from datetime import datetime
+import time
 
 HOME_URL = 'https://api.smartthings.com/v1/'
 APP_HEADERS = {'Authorization': 'Bearer ' + PA_TOKEN}  # Use this header when you don't have an authToken being passed in
 
 STDB = '/home/pi/smartthings/smartthings.db'  #Path to SmartThings DB - It's best to use the full path.
+DB_CACHE_SIZE = -16000  # SQLite page cache for our connection.  Negative values are in KiB, so this is about 16MB.
+DB_CACHED_STATEMENTS = 256  # Number of prepared statements sqlite3 keeps on our connection.
+WRITE_INTERVAL = 2  # Seconds we hold capability state updates before writing them to the database in one batch.
+WRITE_BATCH_SIZE = 200  # Write the batch right away once this many capability updates are waiting.
+CHANGE_LOG_SIZE = 200  # Number of versioned patches we keep so a browser that missed a few can catch up without a full resync.
+FULL_VIEW = 'full'  # What Admins and Users see: all of self.location.
+GUEST_VIEW = 'guest'  # What Guests see: only rooms, devices and scenes with guest_access, see guestLocation().
+# Throttling of device changes sent to the browsers, per (deviceId, capability): capability -> (mode, window in seconds).
+#  'leading' sends the first change right away and holds any more within the window, sending the latest at the end of it.
+#  'latest' also sends the first change right away, then holds the ones after it for the window and sends only the latest.
+#  Capabilities not listed are sent right away.
+THROTTLE_WINDOWS = {
+	'lock': ('leading', 1), 'contactSensor': ('leading', 1), 'doorControl': ('leading', 1),
+	'temperatureMeasurement': ('latest', 30), 'relativeHumidityMeasurement': ('latest', 30), 'battery': ('latest', 60),
+	'motionSensor': ('latest', 2), 'switchLevel': ('latest', 1)}
+NO_ROOM_ID = '0'  # The room_id of devices that aren't in a room (presence sensors).  There's no room row for it.
+
+DEVICE_POOL_SIZE = 10  # Max number of device status/health requests we run at the same time during a bulk refresh.
+DEVICE_TIMEOUT = 10  # Seconds we give any single device status/health request, retries and backoff included, before giving up on it.
+
+API_POOL_SIZE = DEVICE_POOL_SIZE  # Number of keep-alive connections we hold open to the SmartThings API.
+API_TIMEOUT = (5, 15)  # Default (connect, read) timeout in seconds for SmartThings API calls.
+API_RETRIES = 3  # How many times we retry a call that failed to connect or came back with a 5xx (only failed connects for POSTs).
+IDEMPOTENT_METHODS = ('GET', 'DELETE')  # Methods that are safe to send again after a timeout or a 5xx.
+API_BACKOFF = 0.5  # Base delay in seconds between retries.  Doubles each retry and is randomized (jitter).
+
+SUBSCRIBE_DEADLINE = 10  # Seconds an INSTALL/UPDATE lifecycle waits on its subscriptions before answering SmartThings.
+SUBSCRIBE_ATTEMPTS = 5  # Tries per subscription.  The ones still failing after the deadline keep retrying in the background.
+SUBSCRIBE_RETRY_INTERVAL = 20  # Seconds between tries.  Keep the total inside the few minutes an install authToken is good for.
+SUBSCRIBE_RETRY_STATUS = (429,)  # Besides 5xx, the responses worth trying a subscription again for.  Anything else won't change.
 
 # This is the list of supported capabilities and attributes.  Add to this list as you add more support.  This helps keep your JSON payload smaller.
 DEV_LIST = [('presenceSensor', 'presence'), ('battery', 'battery'), ('switch', 'switch'), ('switchLevel', 'level'),
@@ -31,16 +84,418 @@ DEV_LIST = [('presenceSensor', 'presence'), ('battery', 'battery'), ('switch', '
 # This just gives us a list of supported capabilities (the first item in each tuple in DEV_LIST) that we can use to test against later
 CAP_LIST = [cap[0] for cap in DEV_LIST]
 
+def diffItems(old, new, key, exclude=()):
+	#Compares two {id: item} dicts.  Returns {'added': [items], 'removed': [ids], 'changed': [{key: id, field: value, ...}]}
+	#  with only the non-empty lists.  Fields named in exclude are ignored.
+	diff = {}
+	added = [item for itemId, item in new.items() if itemId not in old]
+	removed = [itemId for itemId in old if itemId not in new]
+	changed = []
+	for itemId, item in new.items():
+		if itemId in old:
+			fields = {field: value for field, value in item.items() if field not in exclude and old[itemId].get(field) != value}
+			if fields:
+				fields[key] = itemId
+				changed.append(fields)
+	if added:
+		diff['added'] = added
+	if removed:
+		diff['removed'] = removed
+	if changed:
+		diff['changed'] = changed
+	return diff
+
+def guestAccess(location):
+	#The Guest ACL: {'rooms', 'devices', 'scenes'} sets of the ids Guests may see and use, from the guest_access flags in
+	#  a SmartThings.location.  A device needs its own flag and, unless it's a presence sensor, its room's as well.
+	#  Scenes straight from loadAllScenes() (sceneId, no flag) aren't in it until readAllScenes() reads them back.
+	rooms = {room['roomId'] for room in location['rooms'] if room.get('guest_access') == 1}
+	devices = {device['deviceId'] for device in location['presence'] if device.get('guest_access') == 1}
+	devices.update(device['deviceId'] for room in location['rooms'] if room['roomId'] in rooms
+		for device in room['devices'] if device.get('guest_access') == 1)
+	scenes = {scene['scene_id'] for scene in location.get('scenes', []) if scene.get('guest_access') == 1}
+	return {'rooms': rooms, 'devices': devices, 'scenes': scenes}
+
+def guestLocation(location):
+	#The part of a SmartThings.location a Guest may see, per guestAccess(), and only the locationId and name of the
+	#  location itself.  Shares the items with location, so treat it as read-only.
+	access = guestAccess(location)
+	return {'location': {key: location['location'].get(key, '') for key in ('locationId', 'name')},
+		'presence': [device for device in location['presence'] if device['deviceId'] in access['devices']],
+		'rooms': [dict(room, devices=[device for device in room['devices'] if device['deviceId'] in access['devices']])
+			for room in location['rooms'] if room['roomId'] in access['rooms']],
+		'scenes': [scene for scene in location.get('scenes', []) if scene.get('scene_id') in access['scenes']],
+		'version': location.get('version')}
+
+def diffLocation(old, new):
+	#Works out what changed between two copies of SmartThings.location.  Returns a patch with any of 'location', 'rooms',
+	#  'devices', 'capabilities' and 'scenes', or an empty dict if nothing changed.  Devices carry a 'parent', which is
+	#  their roomId or 'presence'.
+	patch = {}
+	if old['location'] != new['location']:
+		patch['location'] = new['location']
+
+	oldRooms = {room['roomId']: room for room in old['rooms']}
+	newRooms = {room['roomId']: room for room in new['rooms']}
+	rooms = diffItems(oldRooms, newRooms, 'roomId', exclude=('devices',))
+	if 'added' in rooms:
+		rooms['added'] = [{field: value for field, value in room.items() if field != 'devices'} for room in rooms['added']]
+	if rooms:
+		patch['rooms'] = rooms
+
+	def locationDevices(location):
+		devices = {}
+		for pres in location['presence']:
+			devices[pres['deviceId']] = dict(pres, parent='presence')
+		for room in location['rooms']:
+			for device in room['devices']:
+				devices[device['deviceId']] = dict(device, parent=room['roomId'])
+		return devices
+	oldDevices = locationDevices(old)
+	newDevices = locationDevices(new)
+	devices = diffItems(oldDevices, newDevices, 'deviceId', exclude=('capabilities',))
+	if devices:
+		patch['devices'] = devices
+
+	capabilities = {}
+	for deviceId, device in newDevices.items():
+		if deviceId in oldDevices:
+			oldCaps = {cap['id']: cap for cap in oldDevices[deviceId]['capabilities']}
+			newCaps = {cap['id']: cap for cap in device['capabilities']}
+			diff = diffItems(oldCaps, newCaps, 'id')
+			for change, items in diff.items():
+				if change == 'removed':
+					items = [{'id': capId} for capId in items]
+				capabilities.setdefault(change, []).extend([dict(item, deviceId=deviceId) for item in items])
+	if capabilities:
+		patch['capabilities'] = capabilities
+
+	oldScenes = {scene.get('scene_id', scene.get('sceneId')): scene for scene in old.get('scenes', [])}
+	newScenes = {scene.get('scene_id', scene.get('sceneId')): scene for scene in new.get('scenes', [])}
+	scenes = diffItems(oldScenes, newScenes, 'scene_id')
+	if scenes:
+		patch['scenes'] = scenes
+	return patch
+
+
+class SmartThingsAPI:
+	# This is our HTTP client for the SmartThings API.  It holds a pool of keep-alive connections so we don't pay for a new
+	#  TCP/TLS handshake on every call, applies default timeouts, retries connection errors and 5xx responses with a
+	#  jittered backoff, and keeps latency stats per endpoint.  Commands (POSTs) are only retried when the connection
+	#  was never made, so a command SmartThings may already have run isn't sent twice.
+
+	def __init__(self, headers=APP_HEADERS, timeout=API_TIMEOUT, retries=API_RETRIES, backoff=API_BACKOFF, pool_size=API_POOL_SIZE):
+		self.headers = headers
+		self.timeout = timeout
+		self.retries = retries
+		self.backoff = backoff
+		self.session = requests.Session()
+		adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+		self.session.mount('https://', adapter)
+		self.session.mount('http://', adapter)
+		self.latency = {}  # endpoint -> {'count', 'errors', 'total', 'max', 'last'} in seconds
+
+	def endpoint(self, method, url):
+		#Groups URLs by endpoint so latency isn't tracked per device.  IDs in the path are replaced with {id}.
+		parts = urlsplit(url)
+		path = url[len(HOME_URL):].split('?')[0] if url.startswith(HOME_URL) else parts.netloc + parts.path
+		segments = ['{id}' if ('-' in seg and len(seg) >= 20) or seg.isdigit() else seg for seg in path.split('/')]
+		return method + ' ' + '/'.join(segments)
+
+	def record(self, endpoint, started, error=False):
+		elapsed = time.monotonic() - started
+		stats = self.latency.setdefault(endpoint, {'count': 0, 'errors': 0, 'total': 0.0, 'max': 0.0, 'last': 0.0})
+		stats['count'] += 1
+		stats['total'] += elapsed
+		stats['last'] = elapsed
+		if elapsed > stats['max']:
+			stats['max'] = elapsed
+		if error:
+			stats['errors'] += 1
+
+	def stats(self):
+		#Latency summary per endpoint in milliseconds.
+		summary = {}
+		for endpoint, stats in self.latency.items():
+			summary[endpoint] = {'count': stats['count'], 'errors': stats['errors'],
+				'avg_ms': round(stats['total'] / stats['count'] * 1000, 1), 'max_ms': round(stats['max'] * 1000, 1),
+				'last_ms': round(stats['last'] * 1000, 1)}
+		return summary
+
+	def request(self, method, url, headers=None, timeout=None, retries=None, deadline=None, **kwargs):
+		#Sends the request over our pooled session.  For GET/DELETE, connection errors, timeouts and 5xx responses are
+		#  retried with exponential backoff plus jitter.  Other methods are only retried if the connection couldn't be made.
+		#  The last response is returned, or the last exception raised, once retries run out.  deadline (seconds) bounds
+		#  the whole call: each try gets what's left of it, and there's no retry whose backoff would run past it.
+		headers = self.headers if headers is None else headers
+		timeout = self.timeout if timeout is None else timeout
+		retries = self.retries if retries is None else retries
+		endpoint = self.endpoint(method, url)
+		idempotent = method.upper() in IDEMPOTENT_METHODS
+		ends = time.monotonic() + deadline if deadline is not None else None
+		attempt = 0
+		while True:
+			started = time.monotonic()
+			try:
+				if ends is None:
+					r = self.session.request(method, url, headers=headers, timeout=timeout, **kwargs)
+				else:
+					# requests' timeout is per socket operation, so a slow response could still run over without the Timeout.
+					left = max(0.001, ends - started)
+					with eventlet.Timeout(left, requests.exceptions.Timeout('%s deadline of %ss passed' % (endpoint, deadline))):
+						r = self.session.request(method, url, headers=headers, timeout=self.capTimeout(timeout, left), **kwargs)
+			except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+				self.record(endpoint, started, error=True)
+				if attempt >= retries or not (idempotent or self.notSent(e)):
+					raise
+				delay = random.uniform(0, self.backoff * (2 ** attempt))
+				if ends is not None and time.monotonic() + delay >= ends:
+					raise
+				print('%s failed (%s).  Retrying...' % (endpoint, e))
+			else:
+				self.record(endpoint, started, error=r.status_code >= 500)
+				if r.status_code < 500 or attempt >= retries or not idempotent:
+					return r
+				delay = random.uniform(0, self.backoff * (2 ** attempt))
+				if ends is not None and time.monotonic() + delay >= ends:
+					return r
+				print('%s returned %d.  Retrying...' % (endpoint, r.status_code))
+			eventlet.sleep(delay)
+			attempt += 1
+
+	def capTimeout(self, timeout, limit):
+		#timeout (seconds or a (connect, read) tuple) with no part longer than limit.
+		if isinstance(timeout, tuple):
+			return tuple(min(part, limit) for part in timeout)
+		return min(timeout, limit)
+
+	def notSent(self, e):
+		#True if the request failed before a connection was made (DNS, refused, connect timeout), so nothing was sent.
+		if isinstance(e, requests.exceptions.ConnectTimeout):
+			return True
+		reason = getattr(e.args[0], 'reason', None) if e.args else None
+		return isinstance(e, requests.exceptions.ConnectionError) and isinstance(reason, ConnectTimeoutError)
+
+	def get(self, url, **kwargs):
+		return self.request('GET', url, **kwargs)
+
+	def post(self, url, **kwargs):
+		return self.request('POST', url, **kwargs)
+
+	def delete(self, url, **kwargs):
+		return self.request('DELETE', url, **kwargs)
+
+
+class SmartThingsDB:
+	# This keeps one long-lived connection to the SmartThings database instead of opening and closing one on every call.
+	#  The connection runs in WAL mode with synchronous=NORMAL so a commit doesn't wait on a full fsync of the SD card,
+	#  and since it stays open sqlite3 can reuse its prepared statements.  Every greenlet (and every location) shares it,
+	#  so all writes go through transaction(), which holds self.lock until its commit.
+
+	def __init__(self, path=None):
+		self.path = path if path else STDB
+		self.conn = None
+		self.lock = threading.RLock()  # Held for a whole transaction(), so another greenlet's commit can't land in the middle of one.
+
+	def connect(self):
+		#The connection is opened the first time it's needed, so initialize() can still check if the DB file exists first.
+		if self.conn is None:
+			self.conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=DB_CACHED_STATEMENTS)
+			self.conn.row_factory = sqlite3.Row
+			self.conn.execute('PRAGMA journal_mode=WAL')
+			self.conn.execute('PRAGMA synchronous=NORMAL')
+			self.conn.execute('PRAGMA cache_size=%d' % DB_CACHE_SIZE)
+		return self.conn
+
+	def cursor(self):
+		return self.connect().cursor()
+
+	@contextmanager
+	def transaction(self):
+		#Yields a cursor and commits when the block finishes.  Anything written in the block is rolled back if it fails.
+		#  Other greenlets wait for the block to finish before they can start one, so don't wait on the network in it.
+		with self.lock:
+			cursor = self.cursor()
+			try:
+				yield cursor
+			except Exception:
+				self.conn.rollback()
+				raise
+			self.conn.commit()
+
+	def close(self):
+		if self.conn is not None:
+			self.conn.close()
+			self.conn = None
+
+
+class PagedList:
+	# Iterates the items of a SmartThings list endpoint, following _links.next so large accounts aren't cut off at the
+	#  first page.  Pages are fetched as the items are consumed, so only one page is held and decoded at a time.
+	#  After iterating, status is the last HTTP status code, pages is the number of pages read and complete is True
+	#  only if every page was read.
+
+	def __init__(self, api, url, headers=None):
+		self.api = api
+		self.url = url
+		self.headers = headers
+		self.status = None
+		self.pages = 0
+		self.complete = False
+
+	def __iter__(self):
+		url = self.url
+		while url:
+			r = self.api.get(url, headers=self.headers)
+			self.status = r.status_code
+			if r.status_code != 200:
+				return
+			data = json.loads(r.text)
+			self.pages += 1
+			url = ((data.get('_links') or {}).get('next') or {}).get('href')
+			items = data.get('items', [])
+			del data
+			yield from items
+		self.complete = True
+
+
+class CapabilityWriter:
+	# Write-behind buffer for capability state.  The caller updates self.location right away (so emits aren't delayed),
+	#  and the matching 'update capability' rows wait here until they're written together with executemany in one
+	#  transaction, either WRITE_INTERVAL seconds after the first one arrives or once WRITE_BATCH_SIZE are waiting.
+	#  Only the latest value per capability is kept, so a noisy sensor costs one row per batch.
+
+	def __init__(self, db, interval=WRITE_INTERVAL, batch_size=WRITE_BATCH_SIZE):
+		self.db = db
+		self.interval = interval
+		self.batch_size = batch_size
+		self.pending = {}  # (deviceId, capabilityId) -> (state, updated)
+		self.timer = None
+		self.rows_written = 0
+		self.flushes = 0
+
+	def update(self, deviceId, capabilityId, state, updated):
+		self.pending[(deviceId, capabilityId)] = (state, updated)
+		if len(self.pending) >= self.batch_size:
+			self.flush()
+		elif self.timer is None:
+			self.timer = eventlet.spawn_after(self.interval, self.flush)
+
+	def flush(self):
+		#Writes everything that's waiting.  Call this before reading capability state from the database and on shutdown.
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if not self.pending:
+			return 0
+		batch = self.pending
+		self.pending = {}
+		rows = [(state, updated, deviceId, capabilityId) for (deviceId, capabilityId), (state, updated) in batch.items()]
+		try:
+			with self.db.transaction() as cursor:
+				cursor.executemany('update capability set state=?, updated=? where device_id=? and capability_id=?', rows)
+		except sqlite3.Error as e:
+			# Put them back (unless a newer value came in) and try again on the next interval.
+			print('Capability write failed: %s' % e)
+			for key, value in batch.items():
+				self.pending.setdefault(key, value)
+			self.timer = eventlet.spawn_after(self.interval, self.flush)
+			return 0
+		self.rows_written += len(rows)
+		self.flushes += 1
+		return len(rows)
+
+
+class EventThrottle:
+	# Throttles device changes on their way to the browsers, per (deviceId, capability) with THROTTLE_WINDOWS.
+	#  A held change is replaced by a newer one for the same capability (counted as suppressed), and the latest is
+	#  always sent when its window closes, so browsers end up with the current state.  self.location and the database
+	#  are updated as events arrive, this only delays and coalesces the socket messages.
+
+	def __init__(self, emit, windows=THROTTLE_WINDOWS):
+		self.emit = emit  # Called with (locationId, [(event, data)]) for changes released at the end of a window.
+		self.windows = windows
+		self.last = {}  # (deviceId, capabilityId) -> time.monotonic() of the last change sent
+		self.held = {}  # (deviceId, capabilityId) -> (locationId, (event, data)) waiting for its window to close
+		self.timers = {}
+		self.passed = 0
+		self.released = 0
+		self.suppressed = {}  # capabilityId -> count
+
+	def filter(self, locationId, changes):
+		#Returns the changes that should be sent now.  The rest are held and sent through self.emit later.
+		send = []
+		now = time.monotonic()
+		for change in changes:
+			capabilityId = change[1]['capability']
+			key = (change[1]['deviceId'], capabilityId)
+			mode, window = self.windows.get(capabilityId, (None, 0))
+			if mode is None or (key not in self.held and (key not in self.last or now - self.last[key] >= window)):
+				self.last[key] = now
+				self.passed += 1
+				send.append(change)
+				continue
+			if key in self.held:
+				self.suppressed[capabilityId] = self.suppressed.get(capabilityId, 0) + 1
+			self.held[key] = (locationId, change)
+			if key not in self.timers:
+				delay = window if mode == 'latest' else max(0, self.last[key] + window - now)
+				self.timers[key] = eventlet.spawn_after(delay, self.release, key)
+		return send
+
+	def release(self, key):
+		self.timers.pop(key, None)
+		held = self.held.pop(key, None)
+		if held:
+			locationId, change = held
+			self.last[key] = time.monotonic()
+			self.released += 1
+			self.emit(locationId, [change])
+
+	def stats(self):
+		return {'passed': self.passed, 'released': self.released, 'held': len(self.held),
+			'suppressed': dict(self.suppressed), 'suppressed_total': sum(self.suppressed.values())}
+
+
+def installedLocations(api):
+	#The location_ids our SmartApp is installed in, in the order SmartThings lists them.  Empty if the list couldn't be read.
+	locations = []
+	for item in PagedList(api, HOME_URL + 'installedapps?appId=' + ST_WEBHOOK, APP_HEADERS):
+		if item['locationId'] not in locations:
+			locations.append(item['locationId'])
+	return locations
+
+
 class SmartThings:
 
-	def __init__(self, location_id=''): #Pass a location_id if you have multiple locations
+	def __init__(self, location_id='', api=None, db=None, writer=None): #Pass a location_id if you have multiple locations, and an api, db and writer to share them between them
 		self.location_id = location_id
 		self.app_id = ''
 		self.installed_app_id = ''
 		self.app_name = ''
 		self.configuration_id = ''
 		self.name = ''
-		self.location = {'location': {'locationId' : '', 'name' : ''}, 'presence':[], 'rooms' : [], 'scenes': []}
+		self.version = 0  # Goes up by one every time we publish a change to self.location.  Browsers use it to detect gaps.
+		self.change_log = {FULL_VIEW: deque(maxlen=CHANGE_LOG_SIZE), GUEST_VIEW: deque(maxlen=CHANGE_LOG_SIZE)}  # The most recent published patches per view, oldest first.
+		self.location = {'location': {'locationId' : '', 'name' : ''}, 'presence':[], 'rooms' : [], 'scenes': [], 'version': self.version}
+		self.snapshots = {}  # Cached JSON of self.location per view.  Cleared by markDirty() whenever the model changes.
+		self.refresh_summary = {}  # Results of the last bulk device refreshes (success/failed/seconds)
+		self.sync_report = {}  # Last foundation sync per table, see syncReport().
+		self.subscriptions = {}  # subscriptionName -> {'status': 'pending'|'retrying'|'ok'|'failed'|'cancelled', 'attempts', 'code', 'error'} from the last subscribeAll()
+		self.subscribers = []  # The greenlets of the last subscribeAll(), killed by cancelSubscriptions().
+		self.guest_access = None  # guestAccess(self.location), the ids Guests may see and use.  None until read, cleared when rooms, devices or scenes are re-read.
+		self.api = api if api else SmartThingsAPI()  # Shared HTTP client.  All SmartThings API calls go through here.
+		self.shared = db is not None  # Whoever passed in the db (and writer and history) closes them, see close().
+		self.db = db if db else SmartThingsDB()  # Long-lived database connection.  All SmartThings DB queries go through here.
+		self.writer = writer if writer else CapabilityWriter(self.db)  # Buffers capability state writes.  Flushed on an interval and at shutdown.
+		self.history = None  # Optional st_history.HistoryStore.  Device events are recorded in it when it's set.
+		if not self.shared:
+			atexit.register(self.close)
+		# Indexes into self.location so events don't have to scan every room/device/capability.  Rebuilt by readRooms/readDevices.
+		self.rooms = {}  # roomId -> room
+		self.devices = {}  # deviceId -> device (presence sensors and room devices)
+		self.capabilities = {}  # (deviceId, capabilityId) -> capability
+		self.presence_ids = set()  # deviceIds of the devices in self.location['presence']
 
 	def initialize(self, refresh=True):
 		#  This creates and seeds the database, if needed, and updates the database with device status
@@ -50,13 +505,51 @@ class SmartThings:
 		if not exists(STDB):
 			self.createDB()
 			self.loadData()
+		elif not self.readLocation():  # Another location in an existing database, load it the first time.
+			self.loadData()
 		self.readData(refresh)
 
+	def markDirty(self):
+		#Call this whenever self.location changes so the next locationJSON() re-encodes it.
+		self.snapshots = {}
+
+	def locationJSON(self, view=FULL_VIEW):
+		#self.location (or the Guest part of it) encoded as JSON.  It's only re-encoded after the model changes, so every
+		#  connect, refresh and broadcast in between shares the same string.
+		if view not in self.snapshots:
+			self.snapshots[view] = json.dumps(guestLocation(self.location) if view == GUEST_VIEW else self.location)
+		return self.snapshots[view]
+
+	def viewFor(self, role):
+		#Which view of the location a user with this role gets.
+		return GUEST_VIEW if role == 'Guest' else FULL_VIEW
+
+	def viewRoom(self, view):
+		#The socket room for browsers on this view, so broadcasts only reach clients that can see them.
+		return self.location_id if view == FULL_VIEW else self.location_id + '/' + view
+
+	def canSee(self, view, deviceId):
+		#Only devices in this location, and for Guests only the ones they're allowed.
+		return deviceId in self.devices and (view == FULL_VIEW or self.guestAllowed('devices', deviceId))
+
+	def hasScene(self, sceneId):
+		return any(scene.get('scene_id', scene.get('sceneId')) == sceneId for scene in self.location.get('scenes', []))
+
+	def close(self):
+		#Writes any buffered capability state and closes our database connection.  Call this when shutting down.  A shared
+		#  db and history are left open for their owner to close once every location is done with them.
+		self.writer.flush()
+		if self.shared:
+			return
+		self.db.close()
+		if self.history:
+			self.history.close()
+
 	def getInstalledApps(self):
 		#If you only have one location, this will read by AppID to get the installed location_id for you.
 		fullURL = HOME_URL + 'installedapps?appid=' + ST_WEBHOOK
 		headers = APP_HEADERS
-		r = requests.get(fullURL, headers=headers)
+		r = self.api.get(fullURL, headers=headers)
 		print('Get Installed Apps: %d' % r.status_code)
 		if r.status_code == 200:
 			data = json.loads(r.text)
@@ -64,104 +557,99 @@ class SmartThings:
 
 	def createDB(self):
 		# Create our smartthings.db
-		conn = sqlite3.connect(STDB)
-		cursor = conn.cursor()
-
-		create_location_table = '''CREATE TABLE IF NOT EXISTS location(
-			location_id TEXT NOT NULL PRIMARY KEY,
-			name TEXT NOT NULL,
-			nickname TEXT UNIQUE NOT NULL,
-			latitude TEXT,
-			longitude TEXT,
-			time_zone_id TEXT,
-			email TEXT
-			)'''
-		cursor.execute(create_location_table)
-
-		create_app_table = '''CREATE TABLE IF NOT EXISTS app(
-			location_id TEXT NOT NULL,
-			app_id TEXT NOT NULL,
-			installed_app_id TEXT,
-			display_name TEXT,
-			configuration_id TEXT,
-			PRIMARY KEY (location_id, app_id),
-			FOREIGN KEY (location_id)
-			REFERENCES location (location_id)
-			ON DELETE CASCADE
-			ON UPDATE CASCADE
-			)'''
-		cursor.execute(create_app_table)
-
-		create_scene_table = '''CREATE TABLE IF NOT EXISTS scene(
-			scene_id TEXT NOT NULL PRIMARY KEY,
-			name TEXT NOT NULL,
-			location_id TEXT NOT NULL,
-			visible INTEGER,
-			seq INTEGER,
-			guest_access INTEGER,
-			FOREIGN KEY (location_id)
-			REFERENCES location (location_id)
-			ON DELETE CASCADE
-			ON UPDATE CASCADE
-			)'''
-		cursor.execute(create_scene_table)
-
-		create_room_table = '''CREATE TABLE IF NOT EXISTS room(
-			location_id TEXT NOT NULL,
-			room_id TEXT NOT NULL,
-			name TEXT NOT NULL,
-			visible INTEGER,
-			seq INTEGER,
-			guest_access INTEGER,
-			PRIMARY KEY (room_id)
-			FOREIGN KEY (location_id)
-			REFERENCES location (location_id)
-			ON DELETE CASCADE
-			ON UPDATE CASCADE
-			)'''
-		cursor.execute(create_room_table)
-
-		create_device_table = '''CREATE TABLE IF NOT EXISTS device(
-			location_id TEXT NOT NULL,
-			room_id TEXT NOT NULL,
-			device_id TEXT NOT NULL,
-			presentation_id TEXT,
-			name TEXT,
-			health TEXT,
-			label TEXT,
-			category TEXT,
-			device_type_name TEXT,
-			visible INTEGER,
-			seq INTEGER,
-			guest_access INTEGER,
-			nickname TEXT,
-			icon TEXT,
-			PRIMARY KEY (device_id),
-			FOREIGN KEY (room_id)
-			REFERENCES room (room_id)
-			ON DELETE CASCADE
-			ON UPDATE CASCADE
-			)'''
-		cursor.execute(create_device_table)
-
-		create_capability_table = '''CREATE TABLE IF NOT EXISTS capability(
-			location_id TEXT NOT NULL,
-			device_id TEXT NOT NULL,
-			capability_id TEXT NOT NULL,
-			visible INTEGER,
-			state TEXT,
-			seq INTEGER,
-			updated TEXT,
-			PRIMARY KEY (device_id, capability_id),
-			FOREIGN KEY (device_id)
-			REFERENCES device (device_id)
-			ON DELETE CASCADE
-			ON UPDATE CASCADE
-			)'''
-		cursor.execute(create_capability_table)
-
-		conn.commit()
-		conn.close()
+		with self.db.transaction() as cursor:
+			create_location_table = '''CREATE TABLE IF NOT EXISTS location(
+				location_id TEXT NOT NULL PRIMARY KEY,
+				name TEXT NOT NULL,
+				nickname TEXT UNIQUE NOT NULL,
+				latitude TEXT,
+				longitude TEXT,
+				time_zone_id TEXT,
+				email TEXT
+				)'''
+			cursor.execute(create_location_table)
+
+			create_app_table = '''CREATE TABLE IF NOT EXISTS app(
+				location_id TEXT NOT NULL,
+				app_id TEXT NOT NULL,
+				installed_app_id TEXT,
+				display_name TEXT,
+				configuration_id TEXT,
+				PRIMARY KEY (location_id, app_id),
+				FOREIGN KEY (location_id)
+				REFERENCES location (location_id)
+				ON DELETE CASCADE
+				ON UPDATE CASCADE
+				)'''
+			cursor.execute(create_app_table)
+
+			create_scene_table = '''CREATE TABLE IF NOT EXISTS scene(
+				scene_id TEXT NOT NULL PRIMARY KEY,
+				name TEXT NOT NULL,
+				location_id TEXT NOT NULL,
+				visible INTEGER,
+				seq INTEGER,
+				guest_access INTEGER,
+				FOREIGN KEY (location_id)
+				REFERENCES location (location_id)
+				ON DELETE CASCADE
+				ON UPDATE CASCADE
+				)'''
+			cursor.execute(create_scene_table)
+
+			create_room_table = '''CREATE TABLE IF NOT EXISTS room(
+				location_id TEXT NOT NULL,
+				room_id TEXT NOT NULL,
+				name TEXT NOT NULL,
+				visible INTEGER,
+				seq INTEGER,
+				guest_access INTEGER,
+				PRIMARY KEY (room_id)
+				FOREIGN KEY (location_id)
+				REFERENCES location (location_id)
+				ON DELETE CASCADE
+				ON UPDATE CASCADE
+				)'''
+			cursor.execute(create_room_table)
+
+			create_device_table = '''CREATE TABLE IF NOT EXISTS device(
+				location_id TEXT NOT NULL,
+				room_id TEXT NOT NULL,
+				device_id TEXT NOT NULL,
+				presentation_id TEXT,
+				name TEXT,
+				health TEXT,
+				label TEXT,
+				category TEXT,
+				device_type_name TEXT,
+				visible INTEGER,
+				seq INTEGER,
+				guest_access INTEGER,
+				nickname TEXT,
+				icon TEXT,
+				PRIMARY KEY (device_id),
+				FOREIGN KEY (room_id)
+				REFERENCES room (room_id)
+				ON DELETE CASCADE
+				ON UPDATE CASCADE
+				)'''
+			cursor.execute(create_device_table)
+
+			create_capability_table = '''CREATE TABLE IF NOT EXISTS capability(
+				location_id TEXT NOT NULL,
+				device_id TEXT NOT NULL,
+				capability_id TEXT NOT NULL,
+				visible INTEGER,
+				state TEXT,
+				seq INTEGER,
+				updated TEXT,
+				PRIMARY KEY (device_id, capability_id),
+				FOREIGN KEY (device_id)
+				REFERENCES device (device_id)
+				ON DELETE CASCADE
+				ON UPDATE CASCADE
+				)'''
+			cursor.execute(create_capability_table)
 
 	def loadData(self):
 		# Load seed data into the database
@@ -202,6 +690,7 @@ class SmartThings:
 							else:
 								print('Failed loading All Devices Status.')
 						if self.readAllScenes():
+							self.readGuestAccess()
 							print('Data Read...')
 							status = True
 						else:
@@ -217,43 +706,87 @@ class SmartThings:
 		#print(self.location)
 		return status
 
+	def refreshData(self, changed=None):
+		# Pull device status, device health and scenes from the API into a self.location that readData(refresh=False)
+		#  has already built from the database.  This is what readData(refresh=True) does, split into steps so it can
+		#  run in the background while we serve.  changed (if given) is called after each step with a copy of
+		#  self.location from before that step, so the caller can push each step's changes as they arrive.
+		status = True
+		for name, step in (('All Devices Status', self.loadAllDevicesStatus), ('All Devices Health', self.loadAllDevicesHealth),
+							('Scenes', self.loadAllScenes)):
+			previous = self.copyLocation() if changed else None
+			if not step():
+				print(f'Failed loading {name}.')
+				status = False
+			if step == self.loadAllScenes and not self.readAllScenes():
+				print('Failed reading scenes.')
+				status = False
+			if changed:
+				changed(previous)
+		return status
+
+	def syncReport(self, name, stored, fetched, complete=True):
+		#Compares what the API returned with what's in the database for one of the foundation syncs.  stored is
+		#  {id: (fields, visible)} and fetched is {id: fields}, where fields is the tuple of columns the sync writes.
+		#  Returns (and saves in self.sync_report[name]) the ids to insert, update and hide, so only those get written.
+		#  Nothing is hidden unless complete, a listing that failed partway doesn't tell us what was removed.
+		report = {'inserted': [], 'updated': [], 'hidden': [], 'unchanged': 0}
+		for itemId, fields in fetched.items():
+			if itemId not in stored:
+				report['inserted'].append(itemId)
+			elif stored[itemId][0] != fields:
+				report['updated'].append(itemId)
+			else:
+				report['unchanged'] += 1
+		if complete:
+			report['hidden'] = [itemId for itemId, (fields, visible) in stored.items() if itemId not in fetched and visible]
+		self.sync_report[name] = report
+		print('Sync %s: %d inserted, %d updated, %d hidden, %d unchanged' % (name, len(report['inserted']), len(report['updated']), len(report['hidden']), report['unchanged']))
+		return report
+
+	def foundationChanged(self, names=('location', 'app', 'rooms', 'devices')):
+		#True if the last of these foundation syncs wrote anything.
+		return any(report['inserted'] or report['updated'] or report['hidden'] for name, report in self.sync_report.items() if name in names)
+
 	def loadLocation(self):
-		#This will give you all of the location related data and populate the database.
+		#This will give you all of the location related data and populate the database.  Only written if it's new or
+		#  changed, see syncReport().
 		status = False
 		fullURL = HOME_URL + 'locations/' + self.location_id
 		headers = APP_HEADERS
-		r = requests.get(fullURL, headers=headers)
+		r = self.api.get(fullURL, headers=headers)
 		print('Get Location: %d' % r.status_code)
 		if r.status_code == 200:
 			data = json.loads(r.text)
-			conn = sqlite3.connect(STDB)
-			cursor = conn.cursor()
-			update_location = 'update location set name=?, latitude=?, longitude=?, time_zone_id=? where location_id=?'
-			update_values = (data['name'], data['latitude'], data['longitude'], data['timeZoneId'], self.location_id)
-			cursor.execute(update_location, update_values)
-			if cursor.rowcount == 0:
-				insert_location = 'insert into location (location_id, name, nickname, latitude, longitude, time_zone_id, email) values(?,?,?,?,?,?,?)'
-				insert_values = (self.location_id, data['name'], '', data['latitude'], data['longitude'], data['timeZoneId'], '')
-				cursor.execute(insert_location, insert_values)
-			conn.commit()
-			conn.close()
+			# latitude and longitude are TEXT columns, so they're compared (and stored) as the text we write.
+			fields = (data['name'], str(data['latitude']), str(data['longitude']), data['timeZoneId'])
+			with self.db.transaction() as cursor:
+				stored = {row['location_id']: ((row['name'], row['latitude'], row['longitude'], row['time_zone_id']), 1) for row in cursor.execute(
+					'select location_id, name, latitude, longitude, time_zone_id from location where location_id=?', (self.location_id,))}
+				report = self.syncReport('location', stored, {self.location_id: fields}, complete=False)
+				if report['updated']:
+					cursor.execute('update location set name=?, latitude=?, longitude=?, time_zone_id=? where location_id=?', fields + (self.location_id,))
+				elif report['inserted']:
+					insert_location = 'insert into location (location_id, name, nickname, latitude, longitude, time_zone_id, email) values(?,?,?,?,?,?,?)'
+					# nickname is UNIQUE, so a location without one stores its own location_id (see readLocation) rather than ''.
+					insert_values = (self.location_id, fields[0], self.location_id, fields[1], fields[2], fields[3], '')
+					cursor.execute(insert_location, insert_values)
 			status = True
 		return status
 
 	def readLocation(self):
 		#This will read location data from the database and populate self.location
 		status = False
-		conn = sqlite3.connect(STDB)
-		cursor = conn.cursor()
+		cursor = self.db.cursor()
 		for row in cursor.execute('select * from location where location_id=?', (self.location_id,)):
 			location_id, name, nickname, latitude, longitude, time_zone, email = row
 			self.name = name
-			self.display_name = nickname if len(nickname) > 0 else name
+			self.display_name = nickname if len(nickname) > 0 and nickname != location_id else name
 			self.latitude = latitude
 			self.longitude = longitude
-			self.location = {'location': {'locationId' : location_id, 'name' : self.display_name, 'latitude' : latitude, 'longitude' : longitude, 'timeZoneId' : time_zone, 'email' : email}, 'presence':[], 'rooms' : []}
+			self.location = {'location': {'locationId' : location_id, 'name' : self.display_name, 'latitude' : latitude, 'longitude' : longitude, 'timeZoneId' : time_zone, 'email' : email}, 'presence':[], 'rooms' : [], 'version': self.version}
+			self.markDirty()
 			status = True
-		conn.close()
 		return status
 
 	def loadAppConfig(self):
@@ -263,7 +796,7 @@ class SmartThings:
 		status = False
 		fullURL = HOME_URL + 'installedapps?locationId=' + self.location_id + '&appId=' + ST_WEBHOOK
 		headers = APP_HEADERS
-		r = requests.get(fullURL, headers=headers)
+		r = self.api.get(fullURL, headers=headers)
 		print('Get installedAppId: %d' % r.status_code)
 		if r.status_code == 200:
 			print('Config - App *****************************************\n')
@@ -281,338 +814,332 @@ class SmartThings:
 			endURL = '/configs'
 			headers = APP_HEADERS
 			fullURL = baseURL + endURL
-			r = requests.get(fullURL, headers=headers)
+			r = self.api.get(fullURL, headers=headers)
 			print('Get configurationId: %d' % r.status_code)
 			if r.status_code == 200:
 				print('Config ID *****************************************\n')
 				#print(r.text)
 				appData = json.loads(r.text)
-				conn = sqlite3.connect(STDB)
-				cursor = conn.cursor()
 				for item in appData['items']:
 					if item['configurationStatus'] == 'AUTHORIZED':
 						configurationId = item['configurationId']
 						insert_app = 'insert or replace into app values(?,?,?,?,?)'
 						app_values = (self.location_id, ST_WEBHOOK, installedAppId, displayName, configurationId)
-						cursor.execute(insert_app, app_values)
-						conn.commit()
+						with self.db.transaction() as cursor:
+							stored = {ST_WEBHOOK: ((row['installed_app_id'], row['display_name'], row['configuration_id']), 1) for row in cursor.execute(
+								'select installed_app_id, display_name, configuration_id from app where location_id=? and app_id=?', (self.location_id, ST_WEBHOOK))}
+							report = self.syncReport('app', stored, {ST_WEBHOOK: app_values[2:]}, complete=False)
+							if report['inserted'] or report['updated']:
+								cursor.execute(insert_app, app_values)
 						self.app_name = displayName
 						self.configuration_id = configurationId
 						fullURL = fullURL + '/' + configurationId
-						r = requests.get(fullURL, headers=headers)
+						r = self.api.get(fullURL, headers=headers)
 						print('Get appConfig: %d' % r.status_code)
 						if r.status_code == 200:
 							status = True
 							print('Config Data *****************************************\n')
 							print(r.text)
-		conn.close()
 		return status
 
 	def readAppConfig(self):
 		status = False
-		conn = sqlite3.connect(STDB)
-		cursor = conn.cursor()
+		cursor = self.db.cursor()
 		for row in cursor.execute('select installed_app_id, display_name from app where app_id=? and location_id=?', (ST_WEBHOOK, self.location_id)):
 			self.installed_app_id =row[0]
 			self.app_name = row[1]
 			status = True
-		conn.close()
 		return status
 
 	def loadRooms(self):
-		#This will return all rooms at this location and populate the database.
+		#This will return all rooms at this location and populate the database.  Only new, renamed and removed rooms are
+		#  written, see syncReport().
 		status = False
 		baseURL = HOME_URL + 'locations/'
 		endURL = '/rooms'
 		headers = APP_HEADERS
 		fullURL = baseURL + self.location_id + endURL
-		r = requests.get(fullURL, headers=headers)
-		print('Get Rooms: %d' % r.status_code)
-		if r.status_code == 200:
-			data = json.loads(r.text)
-			conn = sqlite3.connect(STDB)
-			cursor = conn.cursor()
-			roomRows = []
-			for row in cursor.execute('select room_id from room where location_id=?', (self.location_id,)):
-				roomRows.append(row[0])
-			update_room = 'update room set name=? where room_id=?'
-			insert_room = 'insert into room (location_id, room_id, name, visible, seq) values(?,?,?,?,?)'
-			for rm in data['items']:
-				update_values = (rm['name'], rm['roomId'])
-				cursor.execute(update_room, update_values)
-				if cursor.rowcount == 1:
-					roomRows.remove(rm['roomId'])
-				else:
-					insert_values = (self.location_id, rm['roomId'], rm['name'], 1, 99)
-					cursor.execute(insert_room, insert_values)
-				conn.commit()
-			for roomId in roomRows:
-				cursor.execute('update room set visible=? where room_id=?', (0, roomId))
-				conn.commit()
-			conn.close()
-			status = True
-		else:
-			print('Get Rooms Failed.  Status: %s' % r.status_cd)
+		rooms = PagedList(self.api, fullURL, headers=headers)
+		fetched = {rm['roomId']: (rm['name'],) for rm in rooms}
+		print('Get Rooms: %d (%d pages)' % (rooms.status, rooms.pages))
+		if rooms.pages:
+			with self.db.transaction() as cursor:
+				stored = {}  # A NO_ROOM_ID placeholder row may be left over in older databases, it isn't a real room.
+				for row in cursor.execute('select room_id, name, visible from room where location_id=? and room_id<>?', (self.location_id, NO_ROOM_ID)):
+					stored[row['room_id']] = ((row['name'],), row['visible'])
+				report = self.syncReport('rooms', stored, fetched, rooms.complete)
+				cursor.executemany('insert into room (location_id, room_id, name, visible, seq) values(?,?,?,?,?)',
+					[(self.location_id, roomId, fetched[roomId][0], 1, 99) for roomId in report['inserted']])
+				cursor.executemany('update room set name=? where room_id=?', [(fetched[roomId][0], roomId) for roomId in report['updated']])
+				cursor.executemany('update room set visible=? where room_id=?', [(0, roomId) for roomId in report['hidden']])
+			status = rooms.complete
+		if not status:
+			print('Get Rooms Failed.  Status: %s' % rooms.status)
 		return status
 
 	def readRooms(self):
 		#Load all room data from the database.
 		status = False
-		conn = sqlite3.connect(STDB)
-		cursor = conn.cursor()
+		cursor = self.db.cursor()
 
 		self.location['rooms'] = []
+		self.rooms = {}
+		self.markDirty()
+		self.guest_access = None
 		
 		for row in cursor.execute('select * from room where location_id=? and visible=?', (self.location_id,1)):
 			location_id, room_id, name, visible_val, seq, guest_access = row
 			room = {'roomId' : room_id, 'name' : name, 'seq': seq, 'guest_access': guest_access, 'devices' : []}
 			self.location['rooms'].append(room)
+			self.rooms[room_id] = room
 			status = True
-		conn.close()
 		return status
 
 	def loadDevices(self):
 		#This will give us all devices at this location, but we have to put them into room groupings or 
-		#  presenceSensor groupings.  Stores the data in the database.
+		#  presenceSensor groupings.  Stores the data in the database.  Only new, changed and removed devices are
+		#  written, see syncReport().
 		status = False
 		baseURL = HOME_URL + 'devices'
 		endURL = '?locationId=' + self.location_id
 		headers = APP_HEADERS
 		fullURL = baseURL + endURL
-		r = requests.get(fullURL, headers=headers)
-		print('Get Devices: %d' % r.status_code)
-		if r.status_code == 200:
-			data = json.loads(r.text)
-			conn = sqlite3.connect(STDB)
-			cursor = conn.cursor()
-			deviceRows = []
-			for row in cursor.execute('select device_id from device where location_id=?', (self.location_id,)):
-				deviceRows.append(row[0])
-			update_device = 'update device set room_id=?, name=?, label=?, category=?, device_type_name=? where device_id=?'
+		stored = {}
+		for row in self.db.cursor().execute('select device_id, room_id, name, label, category, device_type_name, visible from device where location_id=?', (self.location_id,)):
+			stored[row['device_id']] = ((row['room_id'], row['name'], row['label'], row['category'], row['device_type_name']), row['visible'])
+		# Walk the pages keeping just the synced columns of each device (and the capabilities of new ones), so the
+		#  decoded API payload never has to be held for more than a page.  Unchanged devices share the stored tuple,
+		#  so past the stored rows fetched only costs a dict entry per device.
+		devices = PagedList(self.api, fullURL, headers=headers)
+		fetched = {}
+		new_devices = {}  # deviceId -> (presentationId, [capabilityId, ...]) for devices we don't have yet
+		for dev in devices:
+			dtn = dev.get('dth','')
+			if dtn:
+				dtn = dtn.get('deviceTypeName', '')
+			fields = (str(dev.get('roomId', NO_ROOM_ID)), dev['name'], dev['label'], dev['components'][0]['categories'][0]['name'], dtn)
+			if dev['deviceId'] in stored and stored[dev['deviceId']][0] == fields:
+				fields = stored[dev['deviceId']][0]
+			fetched[dev['deviceId']] = fields
+			if dev['deviceId'] not in stored:
+				new_devices[dev['deviceId']] = (dev.get('presentationId',''), [cap['id'] for comp in dev['components'] for cap in comp['capabilities']])
+		print('Get Devices: %d (%d pages)' % (devices.status, devices.pages))
+		if devices.pages:  # An empty list is still an answer: every stored device is gone and gets hidden.
+			status = devices.complete
+			report = self.syncReport('devices', stored, fetched, devices.complete)
 			insert_device = 'insert into device (location_id,room_id,device_id,presentation_id,name,health,label,category,device_type_name,visible,seq,guest_access,nickname,icon) values(?,?,?,?,?,?,?,?,?,?,?,?,?,?)'
 			insert_capability = 'insert into capability (location_id, device_id, capability_id, visible, state, seq, updated) values(?,?,?,?,?,?,?)'
-			for dev in data['items']:
-				dtn = dev.get('dth','')
-				if dtn:
-					dtn = dtn.get('deviceTypeName', '')
-				update_device_values = (dev.get('roomId', 0), dev['name'], dev['label'], dev['components'][0]['categories'][0]['name'], dtn, dev['deviceId'])
-				cursor.execute(update_device, update_device_values)
-				if cursor.rowcount == 1:
-					deviceRows.remove(dev['deviceId'])
-				else:
-					device_insert_values = (self.location_id, dev.get('roomId', 0), dev['deviceId'], dev.get('presentationId',''), dev['name'], '?', dev['label'], dev['components'][0]['categories'][0]['name'], dtn, 1, 99, 0, '', '')
-					cursor.execute(insert_device, device_insert_values)
-					for comp in dev['components']:
-						for cap in comp['capabilities']:
-							capability_values = (self.location_id, dev['deviceId'], cap['id'], 1, '', 99, '')
-							cursor.execute(insert_capability, capability_values)
-				status = True
-				conn.commit()
-			for deviceId in deviceRows:
-				cursor.execute('update device set visible=? where device_id=?', (0, deviceId))
-				conn.commit()
-			conn.close()
+			with self.db.transaction() as cursor:
+				cursor.executemany(insert_device, ((self.location_id, fetched[deviceId][0], deviceId, new_devices[deviceId][0], fetched[deviceId][1], '?',
+					fetched[deviceId][2], fetched[deviceId][3], fetched[deviceId][4], 1, 99, 0, '', '') for deviceId in report['inserted']))
+				cursor.executemany(insert_capability, ((self.location_id, deviceId, capabilityId, 1, '', 99, '')
+					for deviceId in report['inserted'] for capabilityId in new_devices[deviceId][1]))
+				cursor.executemany('update device set room_id=?, name=?, label=?, category=?, device_type_name=? where device_id=?',
+					(fetched[deviceId] + (deviceId,) for deviceId in report['updated']))
+				cursor.executemany('update device set visible=? where device_id=?', ((0, deviceId) for deviceId in report['hidden']))
 		return status
 
 	def readDevices(self):
 		# Reads device data from the database.
 		status = False
-		conn = sqlite3.connect(STDB)
-		cursor = conn.cursor()
-		c2 = conn.cursor()
+		self.writer.flush()  # Make sure the database has the latest capability state before we read it back.
+		cursor = self.db.cursor()
 		self.location['presence'] = []
+		self.markDirty()
+		self.devices = {}
+		self.capabilities = {}
+		self.presence_ids = set()
+		self.guest_access = None
 		for room in self.location['rooms']:
 			room['devices'] = []
+
+		# Load every visible capability for the location in one pass and group them by device.  Each device's
+		#  capabilities come in capability_id order, the order the per-device lookup got from the primary key index.
+		deviceCapabilities = {}
+		for row in cursor.execute('select device_id, capability_id, state, seq, updated from capability where location_id=? and visible=? order by device_id, capability_id',
+				(self.location_id, 1)):
+			status = True
+			c_device_id, c_capability_id, c_state, c_seq, dt = row
+			if c_capability_id in CAP_LIST:
+				capability = {'id' : c_capability_id, 'state' : c_state, 'seq': c_seq, 'updated': dt}
+				deviceCapabilities.setdefault(c_device_id, []).append(capability)
+
 		for row in cursor.execute('select * from device where location_id=? and visible=?', (self.location_id,1)):
 			d_location_id, d_room_id, d_device_id, d_presentation_id, d_name, d_health, d_label, d_category, d_device_type, d_visible, d_seq, d_guest_access, d_nickname, d_icon = row
 			device = {'deviceId' : d_device_id, 'name' : d_name, 'label' : d_nickname if d_nickname else d_label, 'seq': d_seq, 'health': d_health, 
-				'guest_access': d_guest_access, 'icon': d_icon, 'capabilities' : []}
-			for r2 in c2.execute('select * from capability where device_id=? and visible=?', (d_device_id, 1)):
-				status = True
-				c_location_id, c_device_id, c_capability_id, c_visible, c_state, c_seq, dt = r2
-				if c_capability_id in CAP_LIST:
-					capability = {'id' : c_capability_id, 'state' : c_state, 'seq': c_seq, 'updated': dt}
-					device['capabilities'].append(capability)
+				'guest_access': d_guest_access, 'icon': d_icon, 'capabilities' : deviceCapabilities.get(d_device_id, [])}
 			if len(device['capabilities']) > 0 and (d_room_id == 0 or d_room_id == '0'):
 				self.location['presence'].append(device)
+				self.presence_ids.add(d_device_id)
+				self.indexDevice(device)
 			else:
-				if len(device['capabilities']) > 0:
-					for room in self.location['rooms']:
-						if room['roomId'] == d_room_id:
-							room['devices'].append(device)
-
-		conn.close()
+				room = self.rooms.get(d_room_id)
+				if len(device['capabilities']) > 0 and room:
+					room['devices'].append(device)
+					self.indexDevice(device)
 		return status
 
-	def loadAllDevicesStatus(self):
-		#We spin through each device to get the current status of all of it's capabilities.
-		#  This data gets written to the database and updates self.location.
-		status = False
-		baseURL = HOME_URL + 'devices/'
-		headers = APP_HEADERS
-		endURL = '/status'
-
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		dt = datetime.now().strftime('%m/%d/%y %H:%M:%S')
-
+	def allDevices(self):
+		#Every device we're tracking in self.location, presence sensors first and then the room devices.
 		for pres in self.location['presence']:
-			fullURL = baseURL + pres['deviceId'] + endURL
-			r = requests.get(fullURL, headers=headers)
-			if r.status_code == 200:
-				print('Device Loaded: %s' % pres['label'])
-				data = json.loads(r.text)
-
-				main = dict(data.get('components','')).get('main','')
-				if main:
-					for dev in DEV_LIST:
-						cap = dict(main.get(dev[0],'')).get(dev[1],'')
-						if cap:
-							for capability in pres['capabilities']:
-								if capability['id'] == dev[0]:
-									capability['state'] = cap['value']
-									capability['updated'] = dt
-									c1.execute('update capability set state=?, updated=? where device_id=? and capability_id=?', 
-										(cap['value'], dt, pres['deviceId'], dev[0]))
-									conn.commit()
-
+			yield pres
 		for room in self.location['rooms']:
 			for device in room['devices']:
-				fullURL = baseURL + device['deviceId'] + endURL
-				r = requests.get(fullURL, headers=headers)
+				yield device
+
+	def fetchAllDevices(self, endURL):
+		#Runs a GET against devices/{deviceId}{endURL} for every device using a pool of green threads.
+		#  Yields (deviceId, data) as each request finishes, so the caller can write results as they arrive.
+		#  data is None if the request failed or timed out.  Only the id is yielded, self.location may have been
+		#  rebuilt (readData, a foundation sync) while the request was out, so look the device up again.
+		baseURL = HOME_URL + 'devices/'
+		headers = APP_HEADERS
+		results = LightQueue()
+		pool = eventlet.GreenPool(DEVICE_POOL_SIZE)
+
+		def fetch(device):
+			data = None
+			try:
+				r = self.api.get(baseURL + str(device['deviceId']) + endURL, headers=headers, deadline=DEVICE_TIMEOUT)
 				if r.status_code == 200:
-					print('Device Loaded: %s' % device['label'])
 					data = json.loads(r.text)
+				else:
+					print('Get %s Failed: %s - %d' % (endURL, device['label'], r.status_code))
+			except (requests.exceptions.RequestException, ValueError) as e:
+				print('Get %s Failed: %s - %s' % (endURL, device['label'], e))
+			results.put((device['deviceId'], data))
+
+		count = 0
+		for device in self.allDevices():
+			pool.spawn_n(fetch, device)
+			count += 1
+		for _ in range(count):
+			yield results.get()
+
+	def refreshSummary(self, name, success, failed, started):
+		#Records and prints how a bulk device refresh went.
+		summary = {'success': success, 'failed': failed, 'seconds': round(time.monotonic() - started, 2)}
+		self.refresh_summary[name] = summary
+		print('%s: %d loaded, %d failed in %.2fs' % (name, success, failed, summary['seconds']))
+		return summary
+
+	def indexDevice(self, device):
+		#Adds a device and its capabilities to our lookup indexes.
+		self.devices[device['deviceId']] = device
+		for capability in device['capabilities']:
+			self.capabilities[(device['deviceId'], capability['id'])] = capability
 
-					main = dict(data.get('components','')).get('main','')
-					if main:
-						for dev in DEV_LIST:
-							cap = dict(main.get(dev[0],'')).get(dev[1],'')
-							if cap:
-								for capability in device['capabilities']:
-									if capability['id'] == dev[0]:
-										capability['state'] = cap['value']
-										c1.execute('update capability set state=?, updated=? where device_id=? and capability_id=?', 
-											(cap['value'], dt, device['deviceId'], dev[0]))
-										conn.commit()
-										status = True
-		conn.close()
-		return status
+	def loadAllDevicesStatus(self):
+		#We get the current status of all capabilities for every device, several devices at a time.
+		#  This data gets written to the database and updates self.location as each device comes back.
+		started = time.monotonic()
+		success = 0
+		failed = 0
 
-	def loadAllDevicesHealth(self):
-		#Here we spin through all devices to get it's current health status (online/offline).
-		#  This data gets written to the database and updates self.location.
-		status = False
-		baseURL = HOME_URL + 'devices/'
-		headers = APP_HEADERS
-		endURL = '/health'
+		dt = datetime.now().strftime('%m/%d/%y %H:%M:%S')
 
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
+		for deviceId, data in self.fetchAllDevices('/status'):
+			if data is None:
+				failed += 1
+				continue
+			success += 1
+			device = self.devices.get(deviceId)
+			if not device:
+				print('Device %s left location %s before its status came back.' % (deviceId, self.location_id))
+				continue
+			print('Device Loaded: %s' % device['label'])
+			main = dict(data.get('components','')).get('main','')
+			if main:
+				for dev in DEV_LIST:
+					cap = dict(main.get(dev[0],'')).get(dev[1],'')
+					capability = self.capabilities.get((deviceId, dev[0]))
+					if cap and capability:
+						capability['state'] = cap['value']
+						capability['updated'] = dt
+						self.markDirty()
+						self.writer.update(deviceId, dev[0], cap['value'], dt)
+						if self.history:
+							self.history.record(deviceId, dev[0], cap['value'])
+		self.writer.flush()
+		self.refreshSummary('Devices Status', success, failed, started)
+		return success > 0
 
-		for pres in self.location['presence']:
-			deviceId = pres['deviceId']
-			fullURL = baseURL + str(deviceId) + endURL
-			r = requests.get(fullURL, headers=headers)
-			if r.status_code == 200:
-				status = True
-				data = json.loads(r.text)
-				print('Get Presence Health: %s - %s' % (data['state'], pres['label']))
-				pres['health'] = data['state']
+	def loadAllDevicesHealth(self):
+		#Here we get the current health status (online/offline) of every device, several devices at a time.
+		#  This data gets written to the database and updates self.location as each device comes back.
+		started = time.monotonic()
+		success = 0
+		failed = 0
+
+		for deviceId, data in self.fetchAllDevices('/health'):
+			if data is None:
+				failed += 1
+				continue
+			success += 1
+			device = self.devices.get(deviceId)
+			if not device:
+				print('Device %s left location %s before its health came back.' % (deviceId, self.location_id))
+				continue
+			print('Get Device Health: %s - %s' % (data['state'], device['label']))
+			device['health'] = data['state']
+			self.markDirty()
+			with self.db.transaction() as c1:
 				c1.execute('update device set health=? where device_id=?', (data['state'], deviceId))
-				conn.commit()
-
-		for rm in self.location['rooms']:
-			for dev in rm['devices']:
-				deviceId = dev['deviceId']
-				fullURL = baseURL + deviceId + endURL
-				r = requests.get(fullURL, headers=headers)
-				if r.status_code == 200:
-					status = True
-					data = json.loads(r.text)
-					print('Get Device Health: %s - %s' % (data['state'], dev['label']))
-					dev['health'] = data['state']
-					c1.execute('update device set health=? where device_id=?', (data['state'], deviceId))
-					conn.commit()
-		conn.close()
-		return status
+		self.refreshSummary('Devices Health', success, failed, started)
+		return success > 0
 
 	def updateDeviceHealth(self, deviceId, status):
 		#This gets called when a device health event fires.
 		#  It updates the database and self.location.
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		
-		for pres in self.location['presence']:
-			for dev in pres['devices']:
-				if dev['deviceId'] == deviceId:
-					dev['health'] = status
-					c1.execute('update device set health=? where device_id=?', (status, deviceId))
-					conn.commit()
-					conn.close()
-					return True
-
-		for room in self.location['rooms']:
-			for dev in room['devices']:
-				if dev['deviceId'] == deviceId:
-					dev['health'] = status
-					c1.execute('update device set health=? where device_id=?', (status, deviceId))
-					conn.commit()
-					conn.close()
-					return True
+		with self.db.transaction() as c1:
+			return self.applyDeviceHealth(c1, deviceId, status)
+
+	def applyDeviceHealth(self, c1, deviceId, status):
+		#Updates self.location and writes the health change with the cursor we're given.  The caller commits.
+		dev = self.devices.get(deviceId)
+		if dev:
+			dev['health'] = status
+			self.markDirty()
+			c1.execute('update device set health=? where device_id=?', (status, deviceId))
+			return True
 		return False
 
-
 	def loadAllScenes(self):
 		#This will load all scenes and must be filtered for the location and writes them to the database.
 		status = False
 		baseURL = HOME_URL + 'scenes'
 		headers = APP_HEADERS
 		fullURL = baseURL
-		r = requests.get(fullURL, headers=headers)
-		
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		
-		print(f'loadAllScenes() r.status_code: {r.status_code}')
-		if r.status_code == 200:
-			status = True
-			data = json.loads(r.text)
-			#print(f'*****Scenes\nr.text\n******')
-			self.location['scenes'] = []
-			sceneRows = []
-			for row in c1.execute('select scene_id from scene where location_id=?', (self.location_id,)):
-				sceneRows.append(row[0])
-			print('Starting sceneRows: %s' % sceneRows)
-			for scene in data['items']:
-				if scene['locationId'] == self.location_id:
-					scene_data = {'sceneId': scene['sceneId'], 'sceneName': scene['sceneName']}
-					self.location['scenes'].append(scene_data)
-
-					c1.execute('update scene set name=? where scene_id=?', (scene['sceneName'], scene['sceneId']))
-					if c1.rowcount == 0:
-						c1.execute('insert into scene (scene_id,name,location_id,visible,seq) values (?,?,?,?,?)',
-						(scene['sceneId'], scene['sceneName'], self.location_id, 1, 99))
-					else:
-						sceneRows.remove(scene['sceneId'])
-					# ~ c1.execute('insert or replace into scene values (?,?,?,?,?)', 
-						# ~ (scene['sceneId'], scene['sceneName'], self.location_id, 1, 99))
-					conn.commit()
-			print('Ending sceneRows: %s' % sceneRows)
-			for sceneId in sceneRows:
-				c1.execute('delete from scene where scene_id=?', (sceneId,))
-				conn.commit()
-		conn.close()
+		scenes = PagedList(self.api, fullURL, headers=headers)
+		fetched = {}
+		for scene in scenes:
+			if scene['locationId'] == self.location_id:
+				fetched[scene['sceneId']] = (scene['sceneName'],)
+
+		print(f'loadAllScenes() status: {scenes.status} pages: {scenes.pages}')
+		if scenes.pages:
+			status = scenes.complete
+			self.location['scenes'] = [{'sceneId': sceneId, 'sceneName': fields[0]} for sceneId, fields in fetched.items()]
+			self.markDirty()
+			with self.db.transaction() as c1:
+				stored = {}
+				for row in c1.execute('select scene_id, name from scene where location_id=?', (self.location_id,)):
+					stored[row['scene_id']] = ((row['name'],), 1)  # Scenes that go away are deleted, not hidden.
+				report = self.syncReport('scenes', stored, fetched, scenes.complete)
+				c1.executemany('insert into scene (scene_id,name,location_id,visible,seq) values (?,?,?,?,?)',
+					[(sceneId, fetched[sceneId][0], self.location_id, 1, 99) for sceneId in report['inserted']])
+				c1.executemany('update scene set name=? where scene_id=?', [(fetched[sceneId][0], sceneId) for sceneId in report['updated']])
+				c1.executemany('delete from scene where scene_id=?', [(sceneId,) for sceneId in report['hidden']])
 		return status
 
 	def readAllScenes(self):
 		#Reads scenes from the database.
 		status = False
 
-		conn = sqlite3.connect(STDB)
-		conn.row_factory = sqlite3.Row
-		c1 = conn.cursor()
+		c1 = self.db.cursor()
 		self.location['scenes'] = []
+		self.markDirty()
+		self.guest_access = None
 		for scene in c1.execute('select * from scene where location_id=? and visible=?', (self.location_id,1)):
 			self.location['scenes'].append(dict(scene))
 			status = True
@@ -621,62 +1148,181 @@ class SmartThings:
 	def updateDevice(self, deviceId, capability, attribute, value):
 		#This is called when a device event occurs.  It updates the database and self.location data 
 		#  and then returns the values to be emitted to the browsers.
-		print('Updating: %s / %s / %s / %s' % (deviceId, capability, attribute, value))
-
-		emit_data = True
 		emit_val = ()
-		
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
+		change = self.applyDeviceEvent(deviceId, capability, attribute, value)
+		if change:
+			emit_val = (change[0], json.dumps(change[1]))
+		return emit_val
+
+	def applyDeviceEvent(self, deviceId, capability, attribute, value):
+		#Updates self.location and queues the new state for the database.
+		#  Returns (event, data) to be emitted to the browsers, or None if there's nothing to send.
+		print('Updating: %s / %s / %s / %s' % (deviceId, capability, attribute, value))
 		dt = datetime.now().strftime('%m/%d/%y %H:%M:%S')
 
+		cap = self.capabilities.get((deviceId, capability))
+		if cap is None:
+			return None
 		if capability == 'presenceSensor':
-			for pres in self.location['presence']:
-				if pres['deviceId'] == deviceId:
-					for cap in pres['capabilities']:
-						if cap['id'] == capability:
-							cap['state'] = value
-
-							c1.execute('update capability set state=?, updated=? where device_id=? and capability_id=?',
-								(value, dt, deviceId, capability))
-								
-							conn.commit()
-							print(self.location['presence'])
-							dev_json = json.dumps({'deviceId': deviceId,'capability': capability, 'value': value})
-							emit_val = ('presence_chg', dev_json)
+			if deviceId not in self.presence_ids:
+				return None
+			event = 'presence_chg'
 		else:
-			for rm in self.location['rooms']:
-				for dev in rm['devices']:
-					if dev['deviceId'] == deviceId:
-						for cap in dev['capabilities']:
-							if cap['id'] == capability:
-								if cap['state'] == value:
-									emit_data = False
-								cap['state'] = value
-								if emit_data:
-									
-									c1.execute('update capability set state=?, updated=? where device_id=? and capability_id=?',
-										(value, dt, deviceId, capability))
-										
-									conn.commit()									
-									dev_json = json.dumps({'deviceId': deviceId,'capability': capability, 'value': value})
-									emit_val = ('device_chg', dev_json)
-		conn.close()
-		return emit_val
+			if deviceId in self.presence_ids or cap['state'] == value:
+				return None
+			event = 'device_chg'
+		cap['state'] = value
+		self.markDirty()
+		cap['updated'] = dt
+		self.writer.update(deviceId, capability, value, dt)
+		if self.history:
+			self.history.record(deviceId, capability, value)
+		return (event, {'deviceId': deviceId,'capability': capability, 'value': value})
+
+	def updateEvents(self, events):
+		#This is called with every event SmartThings batched into a single webhook EVENT.  Capability changes go through
+		#  the write-behind buffer and health changes are written in one transaction.
+		#  Returns {locationId: {'changes': [(event, data), ...], 'health': [(deviceId, status), ...]}} so the caller can send one message per location.
+		locations = {}
+		health_events = []
+		for event in events:
+			if event['eventType'] == 'DEVICE_EVENT':
+				device = event['deviceEvent']
+				change = self.applyDeviceEvent(device['deviceId'], device['capability'], device['attribute'], device['value'])
+				if change:
+					locations.setdefault(device['locationId'], {'changes': [], 'health': []})['changes'].append(change)
+			elif event['eventType'] == 'DEVICE_HEALTH_EVENT':
+				health_events.append(event['deviceHealthEvent'])
+		if health_events:
+			with self.db.transaction() as c1:
+				for health in health_events:
+					if self.applyDeviceHealth(c1, health['deviceId'], health['status']):
+						locations.setdefault(health['locationId'], {'changes': [], 'health': []})['health'].append((health['deviceId'], health['status']))
+		return locations
+
+	def copyLocation(self):
+		#Take a copy of self.location before a change so publishChanges() can work out what changed.
+		return copy.deepcopy(self.location)
+
+	def publish(self, patches):
+		#Stamps the patch for each view with the version it applies to (base) and the new version, and adds them to the
+		#  change logs.  Every view gets a patch, even an empty one, so Guests stay on the same version as everyone else.
+		#  Returns {view: patch}.
+		base = self.version
+		self.version += 1
+		for view, patch in patches.items():
+			patch['base'] = base
+			patch['version'] = self.version
+			self.change_log[view].append(patch)
+		self.location['version'] = self.version
+		self.markDirty()
+		return patches
+
+	def publishChanges(self, previous):
+		#Publishes whatever changed between a copy of self.location (from copyLocation) and self.location now.
+		#  Returns {view: patch}, or None if nothing changed.
+		patch = diffLocation(previous, self.location)
+		if patch:
+			return self.publish({FULL_VIEW: patch, GUEST_VIEW: diffLocation(guestLocation(previous), guestLocation(self.location))})
+		return None
+
+	def publishDeviceChanges(self, changes):
+		#Publishes capability changes from device events.  changes is a list of (event, data) from applyDeviceEvent.
+		capabilities = []
+		for event, data in changes:
+			capability = self.capabilities.get((data['deviceId'], data['capability']), {})
+			capabilities.append({'deviceId': data['deviceId'], 'id': data['capability'], 'state': data['value'], 'updated': capability.get('updated', '')})
+		guest = [capability for capability in capabilities if self.canSee(GUEST_VIEW, capability['deviceId'])]
+		return self.publish({FULL_VIEW: {'capabilities': {'changed': capabilities}}, GUEST_VIEW: {'capabilities': {'changed': guest}} if guest else {}})
+
+	def publishHealthChanges(self, health):
+		#Publishes device health changes.  health is a list of (deviceId, status).
+		devices = [{'deviceId': deviceId, 'health': status} for deviceId, status in health]
+		guest = [device for device in devices if self.canSee(GUEST_VIEW, device['deviceId'])]
+		return self.publish({FULL_VIEW: {'devices': {'changed': devices}}, GUEST_VIEW: {'devices': {'changed': guest}} if guest else {}})
+
+	def changesSince(self, version, view=FULL_VIEW):
+		#Returns the patches a browser on this view and at this version has missed, or None if they're no longer in the change log.
+		log = self.change_log[view]
+		if version == self.version:
+			return []
+		if not log or version < log[0]['base'] or version > self.version:
+			return None
+		return [patch for patch in log if patch['base'] >= version]
 
 	def deleteSubscriptions(self, authToken, appID):
-		#Deletes all subscriptions.
+		#Deletes all subscriptions.  Retries still pending from subscribeAll() are cancelled first so they can't add any back.
+		self.cancelSubscriptions()
 		baseURL = HOME_URL + 'installedapps/'
 		headers = {'Authorization': 'Bearer ' + authToken}
 		endURL = '/subscriptions'
 
-		r = requests.delete(baseURL + str(appID) + endURL, headers=headers)
+		r = self.api.delete(baseURL + str(appID) + endURL, headers=headers)
 
 		if r.status_code == 200:
 			return True
 
 		return False
 
+	def subscribeAll(self, authToken, locationID, appID, deadline=SUBSCRIBE_DEADLINE):
+		#Creates a capability subscription for everything in DEV_LIST plus the device health subscription, all at the same
+		#  time.  Waits up to deadline seconds and returns True if they all succeeded by then.  Any that failed keep
+		#  retrying in the background, see self.subscriptions for how they're doing.
+		jobs = {'deviceHealthSubscription': lambda: self.deviceHealthSubscriptions(authToken, locationID, appID)}
+		for capability, attribute in DEV_LIST:
+			subName = 'cap' + attribute[0].upper() + attribute[1:] + 'Sub'
+			jobs[subName] = lambda capability=capability, attribute=attribute, subName=subName: self.capabilitySubscriptions(
+				authToken, locationID, appID, capability, attribute, subName)
+		self.cancelSubscriptions()
+		self.subscriptions = {subName: {'status': 'pending', 'attempts': 0, 'code': None, 'error': None} for subName in jobs}
+		pool = eventlet.GreenPool(len(jobs))  # One each, so spawning them never waits past the deadline.
+		self.subscribers = [pool.spawn(self.subscribeWithRetry, subName, subscribe) for subName, subscribe in jobs.items()]
+		with eventlet.Timeout(deadline, False):
+			pool.waitall()
+		status = all(sub['status'] == 'ok' for sub in self.subscriptions.values())
+		print('Subscriptions: %s' % ', '.join('%s=%s' % (subName, sub['status']) for subName, sub in self.subscriptions.items()))
+		return status
+
+	def cancelSubscriptions(self):
+		#Stops the retries of the last subscribeAll().
+		for subscriber in self.subscribers:
+			subscriber.kill()
+		self.subscribers = []
+
+	def subscribeWithRetry(self, subName, subscribe):
+		#Only a 5xx, a SUBSCRIBE_RETRY_STATUS or a failed connection is tried again.  Whatever else goes wrong (or kills
+		#  us) still leaves the subscription 'failed' or 'cancelled' rather than 'pending'.
+		sub = self.subscriptions[subName]
+		try:
+			while sub['attempts'] < SUBSCRIBE_ATTEMPTS:
+				sub['attempts'] += 1
+				try:
+					if subscribe():
+						sub['status'] = 'ok'
+						return True
+					if sub['code'] is not None and sub['code'] < 500 and sub['code'] not in SUBSCRIBE_RETRY_STATUS:
+						break
+				except requests.exceptions.ConnectionError as e:
+					sub['error'] = str(e)
+				if sub['attempts'] < SUBSCRIBE_ATTEMPTS:
+					sub['status'] = 'retrying'
+					eventlet.sleep(SUBSCRIBE_RETRY_INTERVAL)
+		except GreenletExit:
+			sub['status'] = 'cancelled'
+			raise
+		except Exception as e:
+			sub['error'] = str(e)
+		finally:
+			if sub['status'] not in ('ok', 'cancelled'):
+				sub['status'] = 'failed'
+				print('Subscription %s failed after %d attempts: %s' % (subName, sub['attempts'], sub['error'] or sub['code']))
+		return False
+
+	def subscriptionCode(self, subName, code):
+		#Keeps the last response code for a subscription subscribeAll() is making, so it knows whether to try it again.
+		if subName in self.subscriptions:
+			self.subscriptions[subName]['code'] = code
+
 	def deviceHealthSubscriptions(self, authToken, locationID, appID):
 		#Subscribes to device health changes.
 		baseURL = HOME_URL + 'installedapps/'
@@ -691,8 +1337,9 @@ class SmartThings:
 				'subscriptionName':'deviceHealthSubscription'
 				}
 			}
-		r = requests.post(fullURL, headers=headers, json=datasub)
+		r = self.api.post(fullURL, headers=headers, json=datasub)
 		print('Device Health Subscription: %d' % r.status_code)
+		self.subscriptionCode('deviceHealthSubscription', r.status_code)
 		if r.status_code == 200:
 			return True
 
@@ -716,8 +1363,9 @@ class SmartThings:
 				'subscriptionName':subName
 				}
 			}
-		r = requests.post(fullURL, headers=headers, json=datasub)
+		r = self.api.post(fullURL, headers=headers, json=datasub)
 		print('Capability Subscription [%s / %s]: %d' % (capability, attribute, r.status_code))
+		self.subscriptionCode(subName, r.status_code)
 		if r.status_code == 200:
 			return True
 
@@ -742,25 +1390,33 @@ class SmartThings:
 				'subscriptionName':subName
 				}
 			}
-		r = requests.post(fullURL, headers=headers, json=datasub)
+		r = self.api.post(fullURL, headers=headers, json=datasub)
 		print('Device Subscription: %d' % r.status_code)
 		if r.status_code == 200:
 			return True
 
 		return False
 
+	def readGuestAccess(self):
+		#Works out which devices, rooms and scenes Guests may use from self.location, so the Guest view, event filtering
+		#  and command checks all follow the same ACL.
+		self.guest_access = guestAccess(self.location)
+		return self.guest_access
+
+	def guestAllowed(self, kind, itemId):
+		#True if Guests may use this device, room or scene.  kind is 'devices', 'rooms' or 'scenes'.
+		access = self.guest_access if self.guest_access is not None else self.readGuestAccess()
+		return itemId in access[kind]
+
 	def changeDevice(self, deviceId, capability, value, user=None):
 		#This is called when a user requests to change a device state.
 		#  It calls an API which, if successful, will trigger a subsequent device event.
-		if user and user.role == 'Guest':
-			conn = sqlite3.connect(STDB)
-			c1 = conn.cursor()
-			for row in c1.execute('select guest_access from device where device_id=?', (deviceId,)):
-				print('device: %s' % row[0])
-			conn.close()
-			if not row[0] or row[0] != 1:
-				print('Guest not allowed to run this device!')
-				return False
+		if deviceId not in self.devices:  # Our token reaches every location, so only take ids from this one.
+			print('Device %s is not in location %s!' % (deviceId, self.location_id))
+			return False
+		if user and user.role == 'Guest' and not self.guestAllowed('devices', deviceId):
+			print('Guest not allowed to run this device!')
+			return False
 		baseURL = HOME_URL + 'devices/'
 		headers = APP_HEADERS
 		endURL = '/commands'
@@ -786,7 +1442,7 @@ class SmartThings:
 					}
 				]
 			}
-		r = requests.post(fullURL, headers=headers, json=datasub)
+		r = self.api.post(fullURL, headers=headers, json=datasub)
 		print('Change Device: %d' % r.status_code)
 		print (r.text)
 		if r.status_code == 200:
@@ -796,15 +1452,12 @@ class SmartThings:
 
 	def changeThermostat(self, settings, user=None):
 		#This is called when a user requests to change a thermostat.
-		if user and user.role == 'Guest':
-			conn = sqlite3.connect(STDB)
-			c1 = conn.cursor()
-			for row in c1.execute('select guest_access from device where device_id=?', (settings['deviceId'],)):
-				print('device: %s' % row[0])
-			conn.close()
-			if not row[0] or row[0] != 1:
-				print('Guest not allowed to change thermostat!')
-				return False
+		if settings['deviceId'] not in self.devices:
+			print('Device %s is not in location %s!' % (settings['deviceId'], self.location_id))
+			return False
+		if user and user.role == 'Guest' and not self.guestAllowed('devices', settings['deviceId']):
+			print('Guest not allowed to change thermostat!')
+			return False
 		baseURL = HOME_URL + 'devices/'
 		headers = APP_HEADERS
 		endURL = '/commands'
@@ -828,7 +1481,7 @@ class SmartThings:
 		}
 		print(datasub)
 		
-		r = requests.post(fullURL, headers=headers, json=datasub)
+		r = self.api.post(fullURL, headers=headers, json=datasub)
 		print('Change Thermostat: %d' % r.status_code)
 		print (r.text)
 		if r.status_code == 200:
@@ -839,18 +1492,15 @@ class SmartThings:
 	def runScene(self, scene_id, user=None):
 		# Execute a scene
 		print(f'Running scene: {scene_id}')
-		if user and user.role == 'Guest': # If user is a Guest, make sure they have access first
-			conn = sqlite3.connect(STDB)
-			c1 = conn.cursor()
-			for row in c1.execute('select guest_access from scene where scene_id=?', (scene_id,)):
-				print('scene: %s' % row[0])
-			conn.close()
-			if not row[0] or row[0] != 1:
-				print('Guest not allowed to run this scene!')
-				return False
+		if not self.hasScene(scene_id):
+			print('Scene %s is not in location %s!' % (scene_id, self.location_id))
+			return False
+		if user and user.role == 'Guest' and not self.guestAllowed('scenes', scene_id): # If user is a Guest, make sure they have access first
+			print('Guest not allowed to run this scene!')
+			return False
 		fullURL = HOME_URL + 'scenes/' + scene_id + '/execute'
 		headers = APP_HEADERS
-		r = requests.post(fullURL, headers=headers)
+		r = self.api.post(fullURL, headers=headers)
 		print(f'r.status_code: {r.status_code}')
 		if (r.status_code == 200):
 			return True
@@ -860,117 +1510,112 @@ class SmartThings:
 		# Get Location and Room-Level configs.  Used by Admin console.
 		config = {'location': {}, 'rooms': []}
 					
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		c2 = conn.cursor()
-		c3 = conn.cursor()
+		c1 = self.db.cursor()
 		
 		for loc in c1.execute('select location_id, name, nickname, email from location where location_id=?', (self.location_id,)):
-			newLocation = {'location_id': loc[0], 'name': loc[1], 'nickname': loc[2], 'email': loc[3]}
+			newLocation = {'location_id': loc[0], 'name': loc[1], 'nickname': loc[2] if loc[2] != loc[0] else '', 'email': loc[3]}
 		config['location'] = newLocation
-		
-		for rm in c1.execute('select room_id, name, seq, visible, guest_access from room where location_id=?', (self.location_id,)):
-			newRoom = {'room_id': rm[0], 'name': rm[1], 'seq': rm[2], 'visible': rm[3], 'guest_access': 0 if not rm[4] else rm[4], 'devices': []}
-			for dev in c2.execute('select device_id, label, seq, visible, guest_access, icon from device where room_id=?', (rm[0],)):
-				newDevice = {'device_id': dev[0], 'label': dev[1], 'seq': dev[2], 'visible': dev[3], 'guest_access': 0 if not dev[4] else dev[4], 'icon': dev[5] if dev[5] else '', 'capabilities': []}
-				for cap in c3.execute('select capability_id, seq, visible from capability where device_id=?', (dev[0],)):
-					if cap[0] in CAP_LIST:
-						newCapability = {'capability_id': cap[0], 'seq': cap[1], 'visible': cap[2]}
-						newDevice['capabilities'].append(newCapability)
-				if len(newDevice['capabilities']) > 0:
-					newRoom['devices'].append(newDevice)
-			if len(newRoom['devices']) > 0:
+
+		# One query per level, then we put the tree together with dictionary lookups.  Capabilities are in capability_id
+		#  order per device, as readData() has them.
+		capabilities = {}
+		for cap in c1.execute('select device_id, capability_id, seq, visible from capability where location_id=? order by device_id, capability_id', (self.location_id,)):
+			if cap[1] in CAP_LIST:
+				newCapability = {'capability_id': cap[1], 'seq': cap[2], 'visible': cap[3]}
+				capabilities.setdefault(cap[0], []).append(newCapability)
+
+		devices = {}
+		for dev in c1.execute('select device_id, room_id, label, seq, visible, guest_access, icon from device where location_id=?', (self.location_id,)):
+			if dev[0] in capabilities:
+				newDevice = {'device_id': dev[0], 'label': dev[2], 'seq': dev[3], 'visible': dev[4], 'guest_access': 0 if not dev[5] else dev[5], 'icon': dev[6] if dev[6] else '', 'capabilities': capabilities[dev[0]]}
+				devices.setdefault(dev[1], []).append(newDevice)
+
+		for rm in c1.execute('select room_id, name, seq, visible, guest_access from room where location_id=? and room_id<>?', (self.location_id, NO_ROOM_ID)):
+			if rm[0] in devices:
+				newRoom = {'room_id': rm[0], 'name': rm[1], 'seq': rm[2], 'visible': rm[3], 'guest_access': 0 if not rm[4] else rm[4], 'devices': devices[rm[0]]}
 				config['rooms'].append(newRoom)
-		conn.close()
 		return config
 		
 	def updateConfigs(self, configData):
 		# Update location and room configs.
 		status = False
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		location_id = ''
-		nickname = ''
-		email = ''
-		if len(configData['location']) > 0:
-			for item in configData['location']:
-				if item.get('location_id', ''):
-					location_id = item['location_id']
-				elif item.get('nickname',''):
-					nickname = item['nickname']
-				elif item.get('email',''):
-					email = item['email']
-			print('nickname: %s / email: %s' % (nickname, email))
-			c1.execute('update location set nickname=?, email=? where location_id=?', (nickname, email, location_id))
-			status = True
-		print('Room items: %d' % len(configData['rooms']))
-		for room in configData['rooms']:
-			print(room)
-			room_id = room.get('room_id', '')
-			seq = room.get('seq', 99)
-			visible = room.get('visible', 1)
-			guest_access = room.get('guest_access', 0)
-			c1.execute('update room set seq=?, visible=?, guest_access=? where room_id=?', (seq, visible, guest_access, room_id))
-			status = True
-		print('Device items: %d' % len(configData['devices']))
-		for device in configData['devices']:
-			print(device)
-			device_id = device.get('device_id', '')
-			seq = device.get('seq', 99)
-			visible = device.get('visible', 1)
-			guest_access = device.get('guest_access', 0)
-			icon = device.get('icon', '')
-			c1.execute('update device set seq=?, visible=?, guest_access=?, icon=? where device_id=?', (seq, visible, guest_access, icon, device_id))
-			status = True
-		print('Capability items: %d' % len(configData['capabilities']))
-		for capability in configData['capabilities']:
-			print(capability)
-			device_id = capability.get('device_id', '')
-			capability_id = capability.get('capability_id', '')
-			seq = capability.get('seq', 99)
-			visible = capability.get('visible', 1)
-			print(f'seq={seq}, visible={visible}, device_id={device_id}, capability_id={capability_id}')
-			c1.execute('update capability set seq=?, visible=? where device_id=? and capability_id=?', (seq, visible, device_id, capability_id))
-			status = True
-		conn.commit()
-		conn.close()
+		with self.db.transaction() as c1:
+			location_id = ''
+			nickname = ''
+			email = ''
+			if len(configData['location']) > 0:
+				for item in configData['location']:
+					if item.get('location_id', ''):
+						location_id = item['location_id']
+					elif item.get('nickname',''):
+						nickname = item['nickname']
+					elif item.get('email',''):
+						email = item['email']
+				print('nickname: %s / email: %s' % (nickname, email))
+				c1.execute('update location set nickname=?, email=? where location_id=?', (nickname if nickname else location_id, email, location_id))
+				status = True
+			print('Room items: %d' % len(configData['rooms']))
+			for room in configData['rooms']:
+				print(room)
+				room_id = room.get('room_id', '')
+				seq = room.get('seq', 99)
+				visible = room.get('visible', 1)
+				guest_access = room.get('guest_access', 0)
+				c1.execute('update room set seq=?, visible=?, guest_access=? where room_id=?', (seq, visible, guest_access, room_id))
+				status = True
+			print('Device items: %d' % len(configData['devices']))
+			for device in configData['devices']:
+				print(device)
+				device_id = device.get('device_id', '')
+				seq = device.get('seq', 99)
+				visible = device.get('visible', 1)
+				guest_access = device.get('guest_access', 0)
+				icon = device.get('icon', '')
+				c1.execute('update device set seq=?, visible=?, guest_access=?, icon=? where device_id=?', (seq, visible, guest_access, icon, device_id))
+				status = True
+			print('Capability items: %d' % len(configData['capabilities']))
+			for capability in configData['capabilities']:
+				print(capability)
+				device_id = capability.get('device_id', '')
+				capability_id = capability.get('capability_id', '')
+				seq = capability.get('seq', 99)
+				visible = capability.get('visible', 1)
+				print(f'seq={seq}, visible={visible}, device_id={device_id}, capability_id={capability_id}')
+				c1.execute('update capability set seq=?, visible=? where device_id=? and capability_id=?', (seq, visible, device_id, capability_id))
+				status = True
+		self.guest_access = None  # Guest access may have changed, re-read it on the next check.
 		return status
 		
 	def getPresence(self):
 		# Get Presence configs.  Used by Admin console.
 		config = {'presence': []}
 		
-		conn = sqlite3.connect(STDB)
-		conn.row_factory = sqlite3.Row
-		c1 = conn.cursor()
+		c1 = self.db.cursor()
 
-		for sensor in c1.execute('select device_id, label, seq, visible, nickname from device where location_id=? and category=?', (self.location_id, 'MobilePresence')):
-			config['presence'].append(dict(sensor))
-		conn.close()
+		for sensor in c1.execute('select device_id, label, seq, visible, nickname, guest_access from device where location_id=? and category=?', (self.location_id, 'MobilePresence')):
+			sensorRecord = dict(sensor)
+			if sensorRecord['guest_access'] is None:
+				sensorRecord['guest_access'] = 0
+			config['presence'].append(sensorRecord)
 		return config
 		
 	def updatePresenceConfigs(self, configData):
 		# Update Presence configs.
 		status = False
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		if len(configData['presence']) > 0:
-			for sensor in configData['presence']:
-				print(f'Updating {sensor["device_id"]}')
-				c1.execute('update device set nickname=?, seq=?, visible=? where device_id=?', 
-					(sensor['nickname'], sensor['seq'], sensor['visible'], sensor['device_id']))
-				status = True
-			conn.commit()
-		conn.close()
+		with self.db.transaction() as c1:
+			if len(configData['presence']) > 0:
+				for sensor in configData['presence']:
+					print(f'Updating {sensor["device_id"]}')
+					c1.execute('update device set nickname=?, seq=?, visible=?, guest_access=? where device_id=?', 
+						(sensor['nickname'], sensor['seq'], sensor['visible'], sensor.get('guest_access', 0), sensor['device_id']))
+					status = True
 		return status
 	
 	def getScenes(self):
 		# Get Scene-level configs.  Used by Admin console.
 		config = {'scenes': []}
 		
-		conn = sqlite3.connect(STDB)
-		conn.row_factory = sqlite3.Row
-		c1 = conn.cursor()
+		c1 = self.db.cursor()
 		
 		for scene in c1.execute('select * from scene where location_id=?', (self.location_id,)):
 			sceneRecord = dict(scene)
@@ -982,16 +1627,14 @@ class SmartThings:
 	def updateSceneConfigs(self, configData):
 		# Update scene configs.
 		status = False
-		conn = sqlite3.connect(STDB)
-		c1 = conn.cursor()
-		if len(configData['scenes']) > 0:
-			for scene in configData['scenes']:
-				print(f'Updating {scene["scene_id"]}: visible: {scene["visible"]}')
-				c1.execute('update scene set seq=?, visible=?, guest_access=? where scene_id=?', 
-					(scene['seq'], scene['visible'], scene['guest_access'], scene['scene_id']))
-				status = True
-			conn.commit()
-		conn.close()
+		with self.db.transaction() as c1:
+			if len(configData['scenes']) > 0:
+				for scene in configData['scenes']:
+					print(f'Updating {scene["scene_id"]}: visible: {scene["visible"]}')
+					c1.execute('update scene set seq=?, visible=?, guest_access=? where scene_id=?', 
+						(scene['seq'], scene['visible'], scene['guest_access'], scene['scene_id']))
+					status = True
+			self.guest_access = None  # Guest access may have changed, re-read it on the next check.
 		return status
 
 
@@ -0,0 +1,259 @@
+#Capability history for the SmartThings dashboard.  Kept in its own database so it can grow (and be pruned)
+#  without touching smartthings.db.
+
+#eventlet Libs
+import eventlet
+
+#sqlite3 Libs
+import sqlite3
+
+#atexit Libs
+import atexit
+
+import time
+
+#My Libs
+from smartthings import SmartThingsDB
+
+HISTORY_DB = '/home/pi/smartthings/history.db'  #Path to the history DB - It's best to use the full path.
+HISTORY_CAPABILITIES = ('temperatureMeasurement', 'relativeHumidityMeasurement', 'battery', 'switchLevel',
+	'thermostatOperatingState', 'thermostatMode', 'thermostatCoolingSetpoint', 'thermostatHeatingSetpoint')  # Capabilities we keep history for.
+HISTORY_RETENTION_DAYS = 400  # Samples older than this are pruned.
+HISTORY_PRUNE_INTERVAL = 24 * 60 * 60  # Seconds between prunes.
+HISTORY_FLUSH_INTERVAL = 60  # Seconds we hold new samples before writing them in one batch.
+HISTORY_BATCH_SIZE = 500  # Write the batch right away once this many samples are waiting.
+HISTORY_POINTS = 200  # Default number of points a query is downsampled to.
+ROLLUP_RESOLUTIONS = (3600, 86400)  # Seconds per rollup bucket: hourly and daily (UTC) aggregates of numeric capabilities.
+
+class HistoryStore:
+	# Append-only history of capability values.  Each (deviceId, capabilityId) is interned to a small integer series id
+	#  and every sample is a (series_id, ts, value) row of integers/reals in a WITHOUT ROWID table keyed on
+	#  (series_id, ts), so a year of 5-minute samples for 100 sensors (about 10 million rows) stays compact and a range
+	#  query for one series is a single index range scan.  Non-numeric states (thermostatOperatingState etc.) are
+	#  interned to integers as well.  Samples are buffered and written in batches.
+	#  Numeric samples are also rolled up per hour and day (count/min/max/sum/last) as they're written, so a chart over
+	#  a long range reads a few hundred rollup rows instead of every sample, see chart().
+
+	def __init__(self, path=HISTORY_DB, capabilities=HISTORY_CAPABILITIES, retention_days=HISTORY_RETENTION_DAYS):
+		self.db = SmartThingsDB(path)
+		self.capabilities = set(capabilities)
+		self.retention_days = retention_days
+		self.series = {}  # (deviceId, capabilityId) -> series_id
+		self.labels = {}  # state text -> label_id
+		self.label_text = {}  # label_id -> state text
+		self.pending = []  # (series_id, ts, value, label_id) waiting to be written
+		self.timer = None
+		self.pruner = None
+		self.samples_written = 0
+		self.createDB()
+		atexit.register(self.close)
+
+	def createDB(self):
+		with self.db.transaction() as cursor:
+			cursor.execute('''CREATE TABLE IF NOT EXISTS series(
+				series_id INTEGER PRIMARY KEY,
+				device_id TEXT NOT NULL,
+				capability_id TEXT NOT NULL,
+				UNIQUE (device_id, capability_id)
+				)''')
+			cursor.execute('''CREATE TABLE IF NOT EXISTS label(
+				label_id INTEGER PRIMARY KEY,
+				text TEXT NOT NULL UNIQUE
+				)''')
+			cursor.execute('''CREATE TABLE IF NOT EXISTS sample(
+				series_id INTEGER NOT NULL,
+				ts INTEGER NOT NULL,
+				value REAL,
+				label_id INTEGER,
+				PRIMARY KEY (series_id, ts)
+				) WITHOUT ROWID''')
+			cursor.execute('''CREATE TABLE IF NOT EXISTS rollup(
+				series_id INTEGER NOT NULL,
+				resolution INTEGER NOT NULL,
+				bucket INTEGER NOT NULL,
+				count INTEGER NOT NULL,
+				min REAL,
+				max REAL,
+				sum REAL,
+				last REAL,
+				last_ts INTEGER,
+				PRIMARY KEY (series_id, resolution, bucket)
+				) WITHOUT ROWID''')
+			for row in cursor.execute('select series_id, device_id, capability_id from series'):
+				self.series[(row['device_id'], row['capability_id'])] = row['series_id']
+			for row in cursor.execute('select label_id, text from label'):
+				self.labels[row['text']] = row['label_id']
+				self.label_text[row['label_id']] = row['text']
+
+	def seriesId(self, deviceId, capabilityId, create=True):
+		key = (deviceId, capabilityId)
+		if key not in self.series and create:
+			with self.db.transaction() as cursor:
+				cursor.execute('insert into series (device_id, capability_id) values (?,?)', key)
+				self.series[key] = cursor.lastrowid
+		return self.series.get(key)
+
+	def labelId(self, text):
+		if text not in self.labels:
+			with self.db.transaction() as cursor:
+				cursor.execute('insert into label (text) values (?)', (text,))
+				self.labels[text] = cursor.lastrowid
+				self.label_text[cursor.lastrowid] = text
+		return self.labels[text]
+
+	def record(self, deviceId, capabilityId, value, ts=None):
+		#Queues one sample.  Returns False if we don't keep history for this capability.
+		if capabilityId not in self.capabilities or value is None or value == '':
+			return False
+		ts = int(ts if ts is not None else time.time())
+		seriesId = self.seriesId(deviceId, capabilityId)
+		try:
+			value = float(value)
+		except (TypeError, ValueError):
+			self.pending.append((seriesId, ts, None, self.labelId(str(value))))
+		else:
+			self.pending.append((seriesId, ts, value, None))
+		if len(self.pending) >= HISTORY_BATCH_SIZE:
+			self.flush()
+		elif self.timer is None:
+			self.timer = eventlet.spawn_after(HISTORY_FLUSH_INTERVAL, self.flush)
+		return True
+
+	def rollup(self, rollups, seriesId, ts, value):
+		#Adds a numeric sample to its hour and day buckets in rollups, (series_id, resolution, bucket) -> [count, min, max, sum, last, last_ts].
+		for resolution in ROLLUP_RESOLUTIONS:
+			key = (seriesId, resolution, ts - ts % resolution)
+			agg = rollups.get(key)
+			if agg is None:
+				rollups[key] = [1, value, value, value, value, ts]
+			else:
+				agg[0] += 1
+				agg[1] = min(agg[1], value)
+				agg[2] = max(agg[2], value)
+				agg[3] += value
+				if ts >= agg[5]:
+					agg[4] = value
+					agg[5] = ts
+
+	def flush(self):
+		#Writes everything that's waiting.  The first sample for a series and second is the one kept, a later one for
+		#  the same second (in this batch or a later one) is dropped, so the rollups always match the stored samples.
+		if self.timer is not None:
+			self.timer.cancel()
+			self.timer = None
+		if not self.pending:
+			return 0
+		batch = {}  # (series_id, ts) -> sample, the first one queued for each
+		for sample in self.pending:
+			batch.setdefault(sample[:2], sample)
+		self.pending = []
+		try:
+			with self.db.transaction() as cursor:
+				spans = {}  # series_id -> (first ts, last ts) in the batch
+				for seriesId, ts in batch:
+					first, last = spans.get(seriesId, (ts, ts))
+					spans[seriesId] = (min(first, ts), max(last, ts))
+				stored = set()
+				for seriesId, (first, last) in spans.items():
+					for row in cursor.execute('select ts from sample where series_id=? and ts>=? and ts<=?', (seriesId, first, last)):
+						stored.add((seriesId, row['ts']))
+				added = [sample for key, sample in batch.items() if key not in stored]
+				rollups = {}
+				for seriesId, ts, value, labelId in added:
+					if value is not None:
+						self.rollup(rollups, seriesId, ts, value)
+				cursor.executemany('insert or ignore into sample (series_id, ts, value, label_id) values (?,?,?,?)', added)
+				cursor.executemany('''insert into rollup (series_id, resolution, bucket, count, min, max, sum, last, last_ts)
+					values (?,?,?,?,?,?,?,?,?)
+					on conflict (series_id, resolution, bucket) do update set count=count+excluded.count,
+					min=min(min, excluded.min), max=max(max, excluded.max), sum=sum+excluded.sum,
+					last=case when excluded.last_ts>=last_ts then excluded.last else last end, last_ts=max(last_ts, excluded.last_ts)''',
+					[key + tuple(agg) for key, agg in rollups.items()])
+		except sqlite3.Error as e:
+			# Put them back and try again on the next interval.  Their rollups are worked out again then.
+			print('History write failed: %s' % e)
+			self.pending = list(batch.values()) + self.pending
+			self.timer = eventlet.spawn_after(HISTORY_FLUSH_INTERVAL, self.flush)
+			return 0
+		self.samples_written += len(added)
+		return len(added)
+
+	def prune(self):
+		#Deletes samples older than the retention period, one index range per series.
+		cutoff = int(time.time()) - self.retention_days * 24 * 60 * 60
+		with self.db.transaction() as cursor:
+			cursor.executemany('delete from sample where series_id=? and ts<?', [(seriesId, cutoff) for seriesId in self.series.values()])
+			# Hourly rollups go with the samples.  Daily ones are a row per series per day, so we keep them.
+			cursor.executemany('delete from rollup where series_id=? and resolution=? and bucket<?',
+				[(seriesId, ROLLUP_RESOLUTIONS[0], cutoff) for seriesId in self.series.values()])
+		print('History pruned samples before %d' % cutoff)
+
+	def startPruning(self, interval=HISTORY_PRUNE_INTERVAL):
+		#Prunes now and then every interval seconds in the background.
+		def loop():
+			while True:
+				try:
+					self.prune()
+				except sqlite3.Error as e:
+					print('History prune failed: %s' % e)
+				eventlet.sleep(interval)
+		self.pruner = eventlet.spawn(loop)
+
+	def query(self, deviceId, capabilityId, start, end=None, points=HISTORY_POINTS):
+		#Returns the history of one device capability between start and end (epoch seconds) downsampled to at most
+		#  points buckets.  Numeric series give [ts, avg, min, max] per bucket, state series give [ts, state] with the
+		#  last state in each bucket.  ts is the time of the bucket's last sample.
+		self.flush()
+		end = int(end if end is not None else time.time())
+		start = int(start)
+		seriesId = self.seriesId(deviceId, capabilityId, create=False)
+		if seriesId is None or end <= start:
+			return []
+		bucket = max(1, -(-(end - start + 1) // max(1, int(points))))
+		cursor = self.db.cursor()
+		result = []
+		row = cursor.execute('select label_id from sample where series_id=? limit 1', (seriesId,)).fetchone()
+		if row and row['label_id'] is not None:
+			# With max(ts) as the only aggregate SQLite takes label_id from the bucket's last row.
+			for row in cursor.execute('''select max(ts) as ts, label_id from sample where series_id=? and ts>=? and ts<=?
+					group by (ts - ?) / ? order by ts''', (seriesId, start, end, start, bucket)):
+				result.append([row['ts'], self.label_text.get(row['label_id'])])
+		else:
+			for row in cursor.execute('''select max(ts) as ts, avg(value) as avg, min(value) as min, max(value) as max from sample
+					where series_id=? and ts>=? and ts<=? group by (ts - ?) / ? order by ts''', (seriesId, start, end, start, bucket)):
+				result.append([row['ts'], round(row['avg'], 2), row['min'], row['max']])
+		return result
+
+	def chart(self, deviceId, capabilityId, start, end=None, points=HISTORY_POINTS):
+		#Like query(), but reads the coarsest rollup that still gives at least half of points buckets over the range, so
+		#  long ranges (a week and up at the default points) cost about the same as short ones.  Falls back to the
+		#  samples when no rollup is fine enough (short ranges) or for state series.  Buckets line up with the rollup's,
+		#  from the one start falls in.  Returns (resolution, points) where resolution is 0 for samples.
+		end = int(end if end is not None else time.time())
+		start = int(start)
+		seriesId = self.seriesId(deviceId, capabilityId, create=False)
+		if seriesId is None or end <= start:
+			return 0, []
+		resolution = 0
+		for rollupResolution in sorted(ROLLUP_RESOLUTIONS, reverse=True):
+			if (end - start) // rollupResolution >= max(1, int(points) // 2):
+				resolution = rollupResolution
+				break
+		cursor = self.db.cursor()
+		row = cursor.execute('select label_id from sample where series_id=? limit 1', (seriesId,)).fetchone()
+		if resolution == 0 or (row and row['label_id'] is not None):
+			return 0, self.query(deviceId, capabilityId, start, end, points)
+		self.flush()
+		first = start - start % resolution
+		bucket = -(-(end - first + 1) // max(1, int(points)))
+		bucket = max(1, -(-bucket // resolution)) * resolution  # Whole rollup buckets, so none is split between two points.
+		result = []
+		for row in cursor.execute('''select max(bucket) as ts, sum(sum) / sum(count) as avg, min(min) as min, max(max) as max from rollup
+				where series_id=? and resolution=? and bucket>=? and bucket<=? group by (bucket - ?) / ? order by ts''',
+				(seriesId, resolution, first, end, first, bucket)):
+			result.append([row['ts'], round(row['avg'], 2), row['min'], row['max']])
+		return resolution, result
+
+	def close(self):
+		self.flush()
+		self.db.close()
@@ -5,7 +5,7 @@ import eventlet
 eventlet.monkey_patch()
 
 #Flask Libs
-from flask import Flask, abort, request, jsonify, render_template, send_from_directory, session, redirect, url_for, flash
+from flask import Flask, request, jsonify, render_template, send_from_directory, session, redirect, url_for, flash
 
 #Flask Login Libs
 from werkzeug.security import generate_password_hash, check_password_hash
@@ -24,14 +24,52 @@ import json
 
 #datetime
 from datetime import datetime, timedelta
+import time
+
+#atexit Libs
+import atexit
+
+#Archive Libs
+import gzip
+import os
+
+#eventlet queue for webhook events
+from eventlet.queue import LightQueue, Full
+
+#Login limiter
+from collections import deque
 
 #My Libs
-from smartthings import SmartThings
+from smartthings import SmartThings, SmartThingsAPI, SmartThingsDB, CapabilityWriter, EventThrottle, installedLocations
+from st_history import HistoryStore
 from my_secrets.secrets import SECRET_KEY, ST_WEBHOOK, CORS_ALLOWED_ORIGINS
 
 
 # Replace the second item with your local IP address info
 LOCAL_NETWORK_IP = ['127.0.0.1', '192.168.2.']
+LOCATIONS = [] # location_ids to serve.  Empty serves every location the SmartApp is installed in.
+HISTORY = True # Keep capability history (st_history.py) for the history charts.
+BACKGROUND_REFRESH = True # Serve from the database at startup and refresh device status/health/scenes from the API in the background.
+FOUNDATION_SYNC_INTERVAL = 6 * 60 * 60 # Seconds between syncs of the location, app, rooms and devices from the API.  0 turns it off.
+FOUNDATION_SYNC_DELAY = 60 # Seconds after startup before a location's first sync (times the location's place in the list), so a restart picks up what changed while we were down.
+LOG_DATE_FORMAT = '%Y-%m-%d %H:%M:%S' # Log dates are stored in this form so they sort (and range filter) as strings.
+LOG_PAGE_SIZE = 50 # Rows per page on the admin log pages.
+LOG_RETENTION = {'user_login': (365, 100000), 'failed_login': (90, 20000)} # Table -> (days kept, most rows kept).  0 turns either limit off.
+LOG_PRUNE_INTERVAL = 24 * 60 * 60 # Seconds between log prunes.
+LOG_ARCHIVE_DIR = '' # If set, pruned and deleted log rows are appended to gzipped JSON-lines files here first, e.g. '/home/pi/smartthings/log-archive'.
+EVENT_QUEUE_SIZE = 1000 # Webhook event batches waiting to be processed.  Batches arriving while the queue is full are dropped.
+EVENT_WORKERS = 1 # Greenlets processing queued events.  Keep this at 1 unless ordering across batches doesn't matter.
+AUDIT_QUEUE_SIZE = 5000 # Audit (UserLogin) records waiting to be written.  Records arriving while the queue is full are written right away instead.
+AUDIT_BATCH_SIZE = 200 # Most audit records written in one commit.
+AUDIT_FLUSH_INTERVAL = 2 # Seconds the audit writer waits for more records before committing a batch (or trying a failed one again).
+AUDIT_WRITE_ATTEMPTS = 5 # Commits a batch gets before it's appended to AUDIT_FALLBACK_FILE instead.
+AUDIT_FALLBACK_FILE = 'audit-fallback.jsonl' # Audit records we couldn't commit are appended here, one JSON object per line, e.g. '/home/pi/smartthings/audit-fallback.jsonl'.
+LOGIN_WINDOW = 15 * 60 # Seconds in the failed login sliding window.  Failures within it are also summarized in one FailedLogin row.
+LOGIN_MAX_FAILURES = {'ip': 10, 'email': 5} # Failures within LOGIN_WINDOW before further attempts from the IP are rejected unchecked (or for the email, spaced out).
+LOGIN_MAX_DELAY = 30 # Most seconds between attempts for an email past its limit.  Doubles with each failure from 1.  IPs that logged in as it before aren't limited.
+TRUSTED_PROXIES = ('127.0.0.1', '::1') # Peers whose X-Forwarded-For we believe, e.g. a reverse proxy on this Pi.  Anyone else is keyed on their own address.
+LOGIN_LIMITER_KEYS = 10000 # IPs and emails the limiter tracks before it sweeps out the ones with no recent failures.
+USER_CACHE_TTL = 60 # Seconds a loaded user is reused before it's read from the database again.  Admin changes clear it right away.
 
 app = Flask(__name__)
 socketio = SocketIO(app, cors_allowed_origins=CORS_ALLOWED_ORIGINS)
@@ -57,6 +95,7 @@ class User(UserMixin, db.Model): # This is our User class/model.  It will store
     password = db.Column(db.String(100))
     name = db.Column(db.String(1000))
     role = db.Column(db.String(25))
+    location_id = db.Column(db.String(100)) # The location this user sees.  Empty for the first (default) location.
     # db.relationship defines the one-to-many relationship with the UserLogin class/table and can be accessible here (but we won't use it that way)
     #   backref tells sqlalchemy that we can also go from UserLogin to User
     #   lazy='dynamic' tells sqlalchemy not to automatically load the related data into the logins attribute.  It could get large.
@@ -64,6 +103,7 @@ class User(UserMixin, db.Model): # This is our User class/model.  It will store
 
 class UserLogin(db.Model): # This is our UserLogin class/model.  It will store login related data for our users
     __tablename__ = 'user_login'
+    __table_args__ = (db.Index('ix_user_login_user_date', 'user_id', 'date'), db.Index('ix_user_login_date', 'date'))
     id = db.Column(db.Integer, primary_key=True)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id', ondelete='CASCADE'))
     event = db.Column(db.String(50))
@@ -72,11 +112,14 @@ class UserLogin(db.Model): # This is our UserLogin class/model.  It will store l
 
 class FailedLogin(db.Model): # This is our FailedLogin class/model.  It will store failed login attempts.
     __tablename__ = 'failed_login'
+    __table_args__ = (db.Index('ix_failed_login_date', 'date'),)
     id = db.Column(db.Integer, primary_key=True)
     email = db.Column(db.String(100))
     password = db.Column(db.String(100))
-    date = db.Column(db.String(100))
+    date = db.Column(db.String(100)) # First attempt
     ip = db.Column(db.String(50))
+    count = db.Column(db.Integer, nullable=False, server_default='1') # Attempts for this email from this IP within LOGIN_WINDOW
+    last_date = db.Column(db.String(100)) # Last attempt
 
 class UserLogging(db.Model): # This is our UserLogging class/model.  It will allow us to turn logging on/off by login-type.
     __tablename__ = 'user_logging'
@@ -86,6 +129,24 @@ class UserLogging(db.Model): # This is our UserLogging class/model.  It will all
 
 db.create_all() # Creates our database and tables as defined in the above classes.
 
+# create_all() doesn't add indexes to tables that already exist, and older logs have '%m/%d/%y %H:%M:%S' dates which
+#   don't sort.  Both are fixed in place here.  Safe to run on every start.
+for statement in ('CREATE INDEX IF NOT EXISTS ix_user_login_user_date ON user_login (user_id, date)',
+                  'CREATE INDEX IF NOT EXISTS ix_user_login_date ON user_login (date)',
+                  'CREATE INDEX IF NOT EXISTS ix_failed_login_date ON failed_login (date)'):
+    db.session.execute(db.text(statement))
+if 'location_id' not in [row[1] for row in db.session.execute(db.text('PRAGMA table_info(users)'))]: # Added for multiple locations.
+    db.session.execute(db.text('ALTER TABLE users ADD COLUMN location_id VARCHAR(100)'))
+failedColumns = [row[1] for row in db.session.execute(db.text('PRAGMA table_info(failed_login)'))]
+if 'count' not in failedColumns: # Added for summary rows.
+    db.session.execute(db.text('ALTER TABLE failed_login ADD COLUMN count INTEGER NOT NULL DEFAULT 1'))
+if 'last_date' not in failedColumns:
+    db.session.execute(db.text('ALTER TABLE failed_login ADD COLUMN last_date VARCHAR(100)'))
+for table in ('user_login', 'failed_login'):
+    db.session.execute(db.text("update %s set date = '20' || substr(date, 7, 2) || '-' || substr(date, 1, 2) || '-' || substr(date, 4, 2) || substr(date, 9) "
+                               "where date like '__/__/__%%'" % table))
+db.session.commit()
+
 if not UserLogging.query.filter(UserLogging.event == 'login').first():
     log = UserLogging(event = 'login', log_event = True)
     db.session.add(log)
@@ -140,13 +201,280 @@ if not User.query.filter(User.email == 'jeff@example.com').first():
     db.session.commit()
 
 
+startup = {'started': None, 'first_request': None} # Process start and time-to-first-request, in seconds.
+
+api = SmartThingsAPI() # One HTTP client shared by every location.
+database = SmartThingsDB() # One connection to the SmartThings database shared by every location, instead of one per location.
+capability_writer = CapabilityWriter(database) # Shared too, so every location's capability writes go out in the same batches.
+locations = {} # location_id -> SmartThings, one per home we serve.  Each has its own indexes, snapshots and socket rooms.
+history_store = None # HistoryStore shared by every location when HISTORY is on.
+
+def add_location(locationId):
+    # The SmartThings for a location, created (but not loaded, see start_location) the first time we see it.
+    if locationId not in locations:
+        st = SmartThings(locationId, api=api, db=database, writer=capability_writer)
+        st.history = history_store
+        locations[locationId] = st
+    return locations[locationId]
+
+def user_location():
+    # The SmartThings for the current user's location, or None if they may not see any.  Users without a location only
+    #   get one when there's just one location to give them.
+    st = locations.get(getattr(current_user, 'location_id', None) or '')
+    if st is None and len(locations) == 1 and not getattr(current_user, 'location_id', None):
+        st = next(iter(locations.values()))
+    return st
+
+@app.before_request
+def log_first_request():
+    # Log how long after startup we answered our first request.
+    if startup['first_request'] is None and startup['started']:
+        startup['first_request'] = time.time() - startup['started']
+        print('Time to first request: %.2fs (%s %s)' % (startup['first_request'], request.method, request.path))
+
+class LoginLimiter: # Sliding window of failed logins per IP and per email.
+    # Too many failures from an IP block it.  Too many for an email only space its attempts out (and not from IPs that
+    #   have logged in as it before), so guessing at an email can't lock its owner, or the admin, out.
+    def __init__(self, window=LOGIN_WINDOW, limits=LOGIN_MAX_FAILURES, max_delay=LOGIN_MAX_DELAY):
+        self.window = window
+        self.limits = limits # kind ('ip' or 'email') -> failures allowed within the window
+        self.max_delay = max_delay
+        self.failures = {} # (kind, value) -> deque of failure times
+        self.rejected = {} # (kind, value) -> attempts rejected past the limit
+        self.known = {} # email -> IPs that have logged in as it
+        self.next_try = {} # ('email', value) -> time.monotonic() before which attempts for the email are rejected
+        self.summaries = {} # (email, ip) -> (FailedLogin id, time of last failure) for the current summary row
+
+    def keys(self, ip, email):
+        return [('ip', ip or ''), ('email', (email or '').lower())]
+
+    def recent(self, key, now):
+        # The key's failures still inside the window.
+        times = self.failures.get(key)
+        while times and times[0] <= now - self.window:
+            times.popleft()
+        return times
+
+    def blocked(self, ip, email):
+        # Seconds until an attempt from this IP would be allowed, 0 if it's allowed now.  No hashing or database work here.
+        key = self.keys(ip, email)[0]
+        now = time.monotonic()
+        times = self.recent(key, now)
+        if times and len(times) >= self.limits['ip']:
+            self.rejected[key] = self.rejected.get(key, 0) + 1
+            return int(times[0] + self.window - now) + 1
+        return 0
+
+    def spaced(self, ip, email):
+        # Seconds until an attempt for this email would be allowed, 0 if it's allowed now.  Past its limit (unless the IP
+        #   has logged in as it before) one attempt is let through per gap, so parallel attempts don't all get checked.
+        key = self.keys(ip, email)[1]
+        now = time.monotonic()
+        times = self.recent(key, now)
+        if not times or len(times) < self.limits['email'] or ip in self.known.get(key[1], ()):
+            return 0
+        if now < self.next_try.get(key, 0):
+            self.rejected[key] = self.rejected.get(key, 0) + 1
+            return int(self.next_try[key] - now) + 1
+        self.next_try[key] = now + min(self.max_delay, 2 ** (len(times) - self.limits['email']))
+        return 0
+
+    def failed(self, ip, email):
+        now = time.monotonic()
+        for key in self.keys(ip, email):
+            self.failures.setdefault(key, deque()).append(now)
+        if len(self.failures) > LOGIN_LIMITER_KEYS:
+            self.sweep(now)
+
+    def succeeded(self, ip, email):
+        # A good password clears the email's failures (not the IP's), and the IP won't be slowed down for it again.
+        key = self.keys(ip, email)[1]
+        self.failures.pop(key, None)
+        self.rejected.pop(key, None)
+        self.next_try.pop(key, None)
+        self.known.setdefault(key[1], set()).add(ip)
+
+    def sweep(self, now):
+        # Forget keys with no failures left in the window.
+        for key in [key for key in self.failures if not self.recent(key, now)]:
+            del self.failures[key]
+            self.rejected.pop(key, None)
+            self.next_try.pop(key, None)
+        for key in [key for key, (failedId, last) in self.summaries.items() if last <= now - self.window]:
+            del self.summaries[key]
+
+    def summary(self, email, ip):
+        # The FailedLogin id to add this failure to, or None to start a new summary row.
+        now = time.monotonic()
+        summary = self.summaries.get((email, ip))
+        return summary[0] if summary and summary[1] > now - self.window else None
+
+    def summarized(self, email, ip, failedId):
+        self.summaries[(email, ip)] = (failedId, time.monotonic())
+
+    def state(self):
+        # Keys with failures in the window, most failures first, for the admin page.
+        now = time.monotonic()
+        state = []
+        for key in list(self.failures):
+            times = self.recent(key, now)
+            if times:
+                blocked = key[0] == 'ip' and len(times) >= self.limits['ip']
+                state.append({'kind': key[0], 'value': key[1], 'failures': len(times), 'rejected': self.rejected.get(key, 0),
+                              'blocked_for': int(times[0] + self.window - now) + 1 if blocked else 0})
+        return sorted(state, key=lambda entry: entry['failures'], reverse=True)
+
+login_limiter = LoginLimiter()
+
+def client_ip():
+    # The address of whoever connected to us.  Behind one of TRUSTED_PROXIES that's the last X-Forwarded-For entry (the
+    #   one the proxy appended, the ones before it were sent by the client).  From anyone else the header is ignored.
+    forwarded = ','.join(request.headers.getlist('X-Forwarded-For'))
+    if forwarded and request.remote_addr in TRUSTED_PROXIES:
+        return forwarded.split(',')[-1].strip()
+    return request.remote_addr
+
+def record_failed_login(email, password, ip):
+    # Failures for the same email from the same IP within LOGIN_WINDOW update one summary row.
+    now = datetime.now().strftime(LOG_DATE_FORMAT)
+    failedId = login_limiter.summary(email, ip)
+    if failedId is None or not FailedLogin.query.filter(FailedLogin.id == failedId).update(
+            {FailedLogin.count: FailedLogin.count + 1, FailedLogin.last_date: now, FailedLogin.password: password}, synchronize_session=False):
+        failed_user = FailedLogin(email=email, password=password, date=now, last_date=now, ip=ip, count=1)
+        db.session.add(failed_user)
+        db.session.flush()
+        failedId = failed_user.id
+    db.session.commit()
+    login_limiter.summarized(email, ip, failedId)
+
+class SessionUser(UserMixin): # A detached copy of the fields current_user needs, so it can be cached between requests.
+    def __init__(self, user):
+        self.id = user.id
+        self.email = user.email
+        self.name = user.name
+        self.role = user.role
+        self.location_id = user.location_id
+
+user_cache = {} # user_id -> (expires, SessionUser or None)
+logging_flags = {'events': None} # event -> log_event, loaded on first use and cleared by /update-logging
+
+def logging_enabled(event):
+    # Is logging turned on for this event?  The UserLogging table is only read again after it's been changed.
+    if logging_flags['events'] is None:
+        logging_flags['events'] = {log.event: bool(log.log_event) for log in UserLogging.query.all()}
+    return logging_flags['events'].get(event, False)
+
+audit_queue = LightQueue(AUDIT_QUEUE_SIZE) # (time queued, UserLogin row) waiting for the audit writer.
+audit_batch = [] # Rows the audit writer has taken off the queue but not written yet.
+audit_writers = []
+audit_stats = {'queued': 0, 'written': 0, 'direct': 0, 'failed': 0, 'failing': 0, 'fallback': 0, 'lost': 0, 'batches': 0, 'lag_last': 0.0, 'lag_max': 0.0}
+
+def add_user_log(user_id, event, ip):
+    # Queues a UserLogin record for the user.  It's written (with others) by the audit writer, so handlers don't wait
+    #   on a commit.  If the queue is full the record is written right away instead, so none are dropped.
+    if not audit_writers:
+        audit_writers.append(eventlet.spawn(audit_writer))
+    row = {'user_id': user_id, 'event': event, 'date': datetime.now().strftime(LOG_DATE_FORMAT), 'ip': ip}
+    try:
+        audit_queue.put_nowait((time.monotonic(), row))
+    except Full:
+        print('Audit queue full, writing %s event for user %s right away' % (event, user_id))
+        audit_stats['direct'] += 1
+        return commit_audit_rows([(time.monotonic(), row)], final=True)
+    audit_stats['queued'] += 1
+    return True
+
+def audit_writer():
+    # Write queued audit records in batches.  After the first record of a burst we wait AUDIT_FLUSH_INTERVAL for the
+    #   rest (unless a full batch is already waiting) and commit them together.  A batch that failed is still held,
+    #   so it's tried again after the interval.  Runs outside any request, so it has its own app context for db.session.
+    with app.app_context():
+        while True:
+            if not audit_batch:
+                audit_batch.append(audit_queue.get())
+            if audit_queue.qsize() < AUDIT_BATCH_SIZE:
+                eventlet.sleep(AUDIT_FLUSH_INTERVAL)
+            write_audit_batch(AUDIT_BATCH_SIZE)
+
+def write_audit_batch(size=None):
+    # Write what the writer is holding plus up to size records from the queue (all of them if size is None, which is
+    #   also the last try) in one commit.  A failed batch goes back to the front of audit_batch.
+    while audit_queue.qsize() and (size is None or len(audit_batch) < size):
+        audit_batch.append(audit_queue.get_nowait())
+    if not audit_batch:
+        return 0
+    batch = audit_batch[:]
+    del audit_batch[:]
+    if not commit_audit_rows(batch, final=size is None):
+        audit_batch[:0] = batch
+        return 0
+    return len(batch)
+
+def commit_audit_rows(batch, final=False):
+    # Commit (time queued, row) audit records.  After AUDIT_WRITE_ATTEMPTS failures in a row, or the first one if
+    #   final, they're appended to AUDIT_FALLBACK_FILE instead.  Returns False if they should be tried again.
+    try:
+        db.session.execute(UserLogin.__table__.insert(), [row for queued, row in batch])
+        db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        audit_stats['failed'] += 1
+        audit_stats['failing'] += 1
+        print('Audit log write of %d record(s) failed: %s' % (len(batch), e))
+        if not final and audit_stats['failing'] < AUDIT_WRITE_ATTEMPTS:
+            return False
+        audit_stats['failing'] = 0
+        return save_audit_fallback([row for queued, row in batch])
+    audit_stats['failing'] = 0
+    lag = time.monotonic() - batch[0][0]
+    audit_stats['written'] += len(batch)
+    audit_stats['batches'] += 1
+    audit_stats['lag_last'] = lag
+    audit_stats['lag_max'] = max(audit_stats['lag_max'], lag)
+    return True
+
+def save_audit_fallback(rows):
+    # Append audit records we couldn't commit to AUDIT_FALLBACK_FILE so they can be loaded back by hand.
+    try:
+        with open(AUDIT_FALLBACK_FILE, 'a', encoding='utf-8') as fallback:
+            for row in rows:
+                fallback.write(json.dumps(row) + '\n')
+    except OSError as e:
+        audit_stats['lost'] += len(rows)
+        print('Audit fallback to %s failed, %d record(s) lost: %s' % (AUDIT_FALLBACK_FILE, len(rows), e))
+        return True
+    audit_stats['fallback'] += len(rows)
+    print('Audit log wrote %d record(s) to %s' % (len(rows), AUDIT_FALLBACK_FILE))
+    return True
+
+@atexit.register
+def flush_audit_log():
+    # Write everything still waiting.  Called on shutdown.
+    with app.app_context():
+        written = write_audit_batch()
+    if written:
+        print('Audit log flushed %d record(s)' % written)
+    return written
+
+def forget_users(user_id=None):
+    # Drops one user (or all of them) from the cache so the next request reads the database.
+    if user_id is None:
+        user_cache.clear()
+    else:
+        user_cache.pop(int(user_id), None)
+
 @login_manager.user_loader # This is the login manager user loader.  Used to load current_user.
 def load_user(user_id):
+    # Every request and socket event loads the user, so we keep them for USER_CACHE_TTL seconds.
+    user_id = int(user_id)
+    cached = user_cache.get(user_id)
+    if cached and cached[0] > time.time():
+        return cached[1]
     # since the user_id is the primary key of our user table, use it in the query for the user
-    user = User.query.get(int(user_id))
-    if user and user.active and len(user.password) > 0: # Only return the user if they are active
-        return user
-    return None
+    user = User.query.get(user_id)
+    sessionUser = SessionUser(user) if user and user.active and len(user.password) > 0 else None # Only return the user if they are active
+    user_cache[user_id] = (time.time() + USER_CACHE_TTL, sessionUser)
+    return sessionUser
 
 
 @socketio.on('connect')
@@ -156,18 +484,20 @@ def socket_connect():
     # Make sure the current_user is still authenticated.
     if current_user.is_authenticated:
         data = json.dumps({'status': 'connected'})
+        st = user_location()
+        if not st:
+            print('No location for user %s!' % current_user.email)
+            emit('location_data', '', broadcast=False)
+            return
         emit('conn', data, broadcast=False)
-        location_data = json.dumps(st.location)
-        room = st.location_id
+        view = st.viewFor(current_user.role) # Guests only get (and are only sent changes to) what they're allowed to see.
+        location_data = st.locationJSON(view)
+        room = st.viewRoom(view)
         print('Joining room: %s' % room)
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
+        ip = client_ip()
         print('ip: %s' % ip)
-        if UserLogging.query.filter(UserLogging.event == 'connect').filter(UserLogging.log_event == True).first():
-            current_user.logins.append(UserLogin(event='connect', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-            db.session.commit()
+        if logging_enabled('connect'):
+            add_user_log(current_user.id, 'connect', ip)
         join_room(room)
         emit('location_data', location_data, broadcast=False) #We only need to send this to the user currently connecting, not all.
     else:
@@ -177,13 +507,9 @@ def socket_connect():
 @socketio.on('disconnect')
 def socket_disconnect():
     if current_user.is_authenticated:
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        if UserLogging.query.filter(UserLogging.event == 'disconnect').filter(UserLogging.log_event == True).first():
-            current_user.logins.append(UserLogin(event='disconnect', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-            db.session.commit()
+        ip = client_ip()
+        if logging_enabled('disconnect'):
+            add_user_log(current_user.id, 'disconnect', ip)
 
 @socketio.on('pingBack')
 def socket_pingback():
@@ -199,13 +525,9 @@ def socket_disconn():
     try: # Wrapped in a try in case the current_user is no longer active.
         user = User.query.get(int(session['_user_id']))
         if user: # Record the web socket disconnect.  Remove if desired.
-            if request.headers.getlist('X-Forwarded-For'):
-                ip = request.headers.getlist('X-Forwarded-For')[0]
-            else:
-                ip = request.remote_addr
-            if UserLogging.query.filter(UserLogging.event == 'disconnect').filter(UserLogging.log_event == True).first():
-                user.logins.append(UserLogin(event='disconnect', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-                db.session.commit()
+            ip = client_ip()
+            if logging_enabled('disconnect'):
+                add_user_log(user.id, 'disconnect', ip)
     except:
         pass
     disconnect()
@@ -215,20 +537,38 @@ def socket_refresh():
     print(session)
     # Make sure the current_user is still authenticated.
     if current_user.is_authenticated:
+        st = user_location()
         if st:
+            previous = st.copyLocation()
             st.readData(refresh=False)
-            location_data = json.dumps(st.location)
-            emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.
+            broadcast_changes(st, previous) #Broadcast any changes to all users.
+            emit('location_data', st.locationJSON(st.viewFor(current_user.role)), broadcast=False) #The user asking for the refresh gets everything.
         else:
             print('st object not defined!')
     else:
         print('Current user no longer authenticated! [user_id: %s]' % session['_user_id'])
         emit('location_data', '', broadcast=False)  # Send an empty event to notify browser user is no longer authorized
 
+@socketio.on('resync')
+def socket_resync(msg):
+    # The browser missed a versioned change.  Send the patches it missed if we still have them, otherwise everything.
+    if current_user.is_authenticated and user_location():
+        st = user_location()
+        view = st.viewFor(current_user.role)
+        patches = st.changesSince(msg.get('version', -1), view)
+        if patches is None:
+            emit('location_data', st.locationJSON(view), broadcast=False)
+        else:
+            emit('location_patches', json.dumps(patches), broadcast=False)
+    else:
+        print('Current user no longer authenticated! [user_id: %s]' % session['_user_id'])
+        emit('location_data', '', broadcast=False)  # Send an empty event to notify browser user is no longer authorized
+
 @socketio.on('update-device')
 def socket_update_device(msg):
     # Make sure the current_user is still authenticated.
     if current_user.is_authenticated:
+        st = user_location()
         if st:
             print('update-device: %s' % msg)
             st.changeDevice(msg['deviceId'], msg['capability'], msg['state'], current_user)
@@ -242,6 +582,7 @@ def socket_update_device(msg):
 def socket_update_thermostat(msg):
     # Make sure the current_user is still authenticated.
     if current_user.is_authenticated:
+        st = user_location()
         if st:
             print('update-thermostat: %s' % msg)
             st.changeThermostat(msg, current_user)
@@ -254,6 +595,7 @@ def socket_update_thermostat(msg):
 @socketio.on('run-scene')
 def socket_run_scene(msg):
     if current_user.is_authenticated:
+        st = user_location()
         if st:
             print('run-scene: %s' % msg)
             if not st.runScene(msg['scene_id'], current_user):
@@ -284,15 +626,25 @@ def login_post():
     password = request.form.get('password')
     remember = True if request.form.get('remember') else False
 
+    # Capture the IP address so we can check Guest users, limit failures and log it...
+    ip = client_ip()
+
+    # Too many recent failures from this IP?  Reject before any hashing or database work.
+    wait = login_limiter.blocked(ip, email)
+    if wait:
+        print('Login rejected by limiter [email: %s ip: %s]' % (email, ip))
+        flash('Too many failed logins.  Please try again in %d minute(s).' % -(-wait // 60))
+        return render_template('login.html', next_page=url_for('index')), 429
+    # Too many for this email?  Only one attempt per gap, so its owner can still get in.
+    wait = login_limiter.spaced(ip, email)
+    if wait:
+        print('Login spaced out by limiter for %ds [email: %s ip: %s]' % (wait, email, ip))
+        flash('Too many failed logins.  Please try again in %d second(s).' % wait)
+        return render_template('login.html', next_page=url_for('index')), 429
+
     user = User.query.filter_by(email=email).filter_by(active=True).first() # Let's see if this user exists...
     print('User: %s' % user)
 
-    # Capture the IP address so we can check Guest users and log it...
-    if request.headers.getlist('X-Forwarded-For'):
-        ip = request.headers.getlist('X-Forwarded-For')[0]
-    else:
-        ip = request.remote_addr
-
     if user and user.role == 'Guest': # If this is a Guest user, make sure they are logging in from the local network only...
         if LOCAL_NETWORK_IP[0] in ip or LOCAL_NETWORK_IP[1] in ip:
             print(f'Guest User [{user.name}] is connected to local network.  Allowed...')
@@ -307,14 +659,14 @@ def login_post():
         print('Setup user!')
         user.password=generate_password_hash(password, method='sha256')
         db.session.commit()
+        forget_users(user.id)
 
     # Check if the user actually exists and is active
     # Take the user-supplied password, hash it, and compare it to the hashed password in the database
     if not user or not user.active or not check_password_hash(user.password, password):
-        # If there's a problem, create a FailedLogin event.
-        failed_user = FailedLogin(email=email, password=password, date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip)
-        db.session.add(failed_user)
-        db.session.commit()
+        # If there's a problem, record the FailedLogin event.
+        login_limiter.failed(ip, email)
+        record_failed_login(email, password, ip)
 
         flash('Please check your login details and try again.')
         return redirect(url_for('login')) # if the user doesn't exist or password is wrong, reload the page
@@ -327,13 +679,13 @@ def login_post():
         pass
 
     # If the above check passes, then we know the user has the right credentials
+    login_limiter.succeeded(ip, email)
     login_user(user, remember=remember)
     session.permanent = True # This is the flask session.  It's set to permanent, but the PERMANENT_SESSION_LIFETIME is applied for expiration.
 
     # Record the login event.  Remove if desired.
-    if UserLogging.query.filter(UserLogging.event == 'login').filter(UserLogging.log_event == True).first():
-        user.logins.append(UserLogin(event='login', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+    if logging_enabled('login'):
+        add_user_log(user.id, 'login', ip)
 
     # This is the next query parameter that we passed through from the login GET request.
     #  If it was set, we want to now redirect the user to the URL they originally tried to go to.
@@ -346,13 +698,9 @@ def login_post():
 @app.route('/logout')
 def logout():
     if current_user.is_authenticated:  # If the user is logged in, record the event and log them out.
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        if UserLogging.query.filter(UserLogging.event == 'logout').filter(UserLogging.log_event == True).first():
-            current_user.logins.append(UserLogin(event='logout', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-            db.session.commit()
+        ip = client_ip()
+        if logging_enabled('logout'):
+            add_user_log(current_user.id, 'logout', ip)
         logout_user()
     return redirect(url_for('login')) # Logged in or not, redirect to the login page.
 
@@ -362,26 +710,102 @@ def logout():
 def admin():
     if current_user.role != 'Admin':
         return redirect(url_for('index'))
-    if UserLogging.query.filter(UserLogging.event == 'config-view').filter(UserLogging.log_event == True).first():
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        current_user.logins.append(UserLogin(event='config-view', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+    if logging_enabled('config-view'):
+        ip = client_ip()
+        add_user_log(current_user.id, 'config-view', ip)
     return render_template('admin_home.html')
 
+# Admin Stats (webhook event and audit log queues and SmartThings API latency)
+@app.route('/admin-stats')
+@login_required
+def admin_stats():
+    if current_user.role != 'Admin':
+        return 'Fail', 403
+    handled = event_stats['processed'] + event_stats['failed']
+    events = dict(event_stats, depth=event_queue.qsize(), workers=len(event_workers),
+        latency_avg=event_stats['latency_total'] / handled if handled else 0.0)
+    audit = dict(audit_stats, depth=audit_queue.qsize() + len(audit_batch))
+    return jsonify({'events': events, 'audit': audit, 'throttle': throttle.stats(), 'subscriptions': {locationId: st.subscriptions for locationId, st in locations.items()}, 'api': api.stats()})
+
+# History for one device capability, downsampled for a chart.  start/end are epoch seconds, end defaults to now.
+#   Long ranges are read from the hourly/daily rollups, resolution says which (0 is the raw samples).
+@app.route('/history')
+@login_required
+def history():
+    deviceId = request.args.get('deviceId', '')
+    capability = request.args.get('capability', '')
+    st = user_location()
+    if not st or not st.history or not st.canSee(st.viewFor(current_user.role), deviceId):
+        return 'Fail', 404
+    try:
+        end = int(request.args.get('end', time.time()))
+        start = int(request.args.get('start', end - 24 * 60 * 60))
+        points = min(int(request.args.get('points', 200)), 2000)
+    except ValueError:
+        return 'Fail', 400
+    resolution, data = st.history.chart(deviceId, capability, start, end, points)
+    return jsonify({'deviceId': deviceId, 'capability': capability, 'start': start, 'end': end, 'resolution': resolution, 'points': data})
+
+def log_filters():
+    # Paging, filtering and sorting arguments for the admin log pages.  Dates are 'YYYY-MM-DD', anything else is ignored.
+    return {'page': max(request.args.get('page', 1, type=int), 1), 'user': request.args.get('user', ''), 'event': request.args.get('event', ''),
+            'start': filter_date(request.args.get('start', '')), 'end': filter_date(request.args.get('end', '')),
+            'order': 'asc' if request.args.get('order') == 'asc' else 'desc'}
+
+def filter_date(value):
+    try:
+        return datetime.strptime(value, '%Y-%m-%d').strftime('%Y-%m-%d')
+    except (TypeError, ValueError):
+        return ''
+
+def range_filters(filters):
+    # The filters a page sent with a delete of everything matching them, with the dates checked like log_filters().
+    #   None if anything isn't what the page sends, so we never delete on a range we can't read.
+    if not isinstance(filters, dict) or not all(isinstance(filters.get(key, ''), str) for key in ('user', 'event', 'start', 'end')):
+        return None
+    filters = dict(filters)
+    for key in ('start', 'end'):
+        if filters.get(key):
+            filters[key] = filter_date(filters[key])
+            if not filters[key]:
+                return None
+    return filters
+
+def filter_dates(query, column, filters):
+    return query.filter(date_range(column, filters))
+
+def date_range(column, filters):
+    # The condition for the filters' start and end dates (either may be empty).
+    condition = db.true()
+    if filters.get('start'):
+        condition = condition & (column >= filters['start'])
+    if filters.get('end'):
+        condition = condition & (column <= filters['end'] + ' 23:59:59')
+    return condition
+
+def order_by_date(query, model, filters):
+    if filters['order'] == 'asc':
+        return query.order_by(model.date.asc(), model.id.asc())
+    return query.order_by(model.date.desc(), model.id.desc())
+
 # Admin View User Logs
 @app.route('/admin-view-logs')
 @login_required
 def admin_view_logs():
     if current_user.role != 'Admin':
         return redirect(url_for('index'))
-    results = UserLogin.query.all()
-    logData = {'logs': []}
-    for log in results:
-        email = User.query.get(log.user_id).email
-        logData['logs'].append({'id': log.id, 'user_id': log.user_id, 'email': email, 'event': log.event, 'date': log.date, 'ip': log.ip})
+    filters = log_filters()
+    query = db.session.query(UserLogin, User.email).outerjoin(User, User.id == UserLogin.user_id) # One joined query for the page.
+    if filters['user']:
+        query = query.filter(User.email == filters['user'])
+    if filters['event']:
+        query = query.filter(UserLogin.event == filters['event'])
+    query = filter_dates(query, UserLogin.date, filters)
+    page = order_by_date(query, UserLogin, filters).paginate(page=filters['page'], per_page=LOG_PAGE_SIZE, error_out=False)
+    logData = dict(filters, page=page.page, pages=page.pages, total=page.total, logs=[],
+        users=[user.email for user in User.query.order_by(User.email)], events=[log.event for log in UserLogging.query.order_by(UserLogging.event)])
+    for log, email in page.items:
+        logData['logs'].append({'id': log.id, 'user_id': log.user_id, 'email': email or '', 'event': log.event, 'date': log.date, 'ip': log.ip})
     return render_template('admin_logs.html', logData=logData)
 
 # Admin Delete User Logs
@@ -393,18 +817,22 @@ def admin_delete_logs():
         return 'Fail', 403
     logData = request.get_json()
     print('logData: %s' % logData)
-    for log in logData['logs']:
-        logRecord = UserLogin.query.get(log['id'])
-        if logRecord:
-            db.session.delete(logRecord)
-            db.session.commit()
-    if UserLogging.query.filter(UserLogging.event == 'log-delete').filter(UserLogging.log_event == True).first():
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        current_user.logins.append(UserLogin(event='log-delete', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+    if 'range' in logData: # Everything matching the page's filters, not just the page.
+        filters = range_filters(logData['range'])
+        if filters is None:
+            return 'Fail', 400
+        condition = db.true()
+        if filters.get('user'):
+            condition = condition & UserLogin.user_id.in_(db.session.query(User.id).filter(User.email == filters['user']))
+        if filters.get('event'):
+            condition = condition & (UserLogin.event == filters['event'])
+        condition = condition & date_range(UserLogin.date, filters)
+    else:
+        condition = UserLogin.id.in_([int(log['id']) for log in logData['logs']])
+    print('Deleted %d user log record(s)' % delete_logs(UserLogin, condition))
+    if logging_enabled('log-delete'):
+        ip = client_ip()
+        add_user_log(current_user.id, 'log-delete', ip)
     return 'OK', 200
 
 # Admin Failed Logins
@@ -413,10 +841,16 @@ def admin_delete_logs():
 def admin_failed_logins():
     if current_user.role != 'Admin':
         return redirect(url_for('index'))
-    results = FailedLogin.query.all()
-    logData = {'data': []}
-    for data in results:
-        logData['data'].append({'id': data.id, 'email': data.email, 'password': data.password, 'date': data.date, 'ip': data.ip})
+    filters = log_filters()
+    query = FailedLogin.query
+    if filters['user']:
+        query = query.filter(FailedLogin.email == filters['user'])
+    query = filter_dates(query, FailedLogin.date, filters)
+    page = order_by_date(query, FailedLogin, filters).paginate(page=filters['page'], per_page=LOG_PAGE_SIZE, error_out=False)
+    logData = dict(filters, page=page.page, pages=page.pages, total=page.total, data=[], limiter=login_limiter.state())
+    for data in page.items:
+        logData['data'].append({'id': data.id, 'email': data.email, 'password': data.password, 'date': data.date, 'ip': data.ip,
+                                'count': data.count, 'last_date': data.last_date or data.date})
     return render_template('admin_failed_login.html', logData=logData)
 
 # Admin Delete Failed Login
@@ -428,18 +862,20 @@ def admin_delete_failed_login():
         return 'Fail', 403
     logData = request.get_json()
     print('logData: %s' % logData)
-    for log in logData['logs']:
-        logRecord = FailedLogin.query.get(log['id'])
-        if logRecord:
-            db.session.delete(logRecord)
-            db.session.commit()
-    if UserLogging.query.filter(UserLogging.event == 'log-delete').filter(UserLogging.log_event == True).first():
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        current_user.logins.append(UserLogin(event='log-delete', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+    if 'range' in logData: # Everything matching the page's filters, not just the page.
+        filters = range_filters(logData['range'])
+        if filters is None:
+            return 'Fail', 400
+        condition = db.true()
+        if filters.get('user'):
+            condition = condition & (FailedLogin.email == filters['user'])
+        condition = condition & date_range(FailedLogin.date, filters)
+    else:
+        condition = FailedLogin.id.in_([int(log['id']) for log in logData['logs']])
+    print('Deleted %d failed login record(s)' % delete_logs(FailedLogin, condition))
+    if logging_enabled('log-delete'):
+        ip = client_ip()
+        add_user_log(current_user.id, 'log-delete', ip)
     return 'OK', 200
 
 # Admin Configure Logging
@@ -469,13 +905,10 @@ def update_logging():
         if logRecord:
             logRecord.log_event = True if log['log_event'] == '1' else False
             db.session.commit()
-    if UserLogging.query.filter(UserLogging.event == 'config-update').filter(UserLogging.log_event == True).first():
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        current_user.logins.append(UserLogin(event='config-update', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+    logging_flags['events'] = None
+    if logging_enabled('config-update'):
+        ip = client_ip()
+        add_user_log(current_user.id, 'config-update', ip)
     return 'OK', 200
 
 # Admin Maintain Users
@@ -487,7 +920,9 @@ def admin_users():
     results = User.query.all()
     userData = {"users": []}
     for user in results:
-        userData['users'].append({"id": user.id, "name": user.name, "email": user.email, "role": user.role, "active": 1 if user.active else 0})
+        userData['users'].append({"id": user.id, "name": user.name, "email": user.email, "role": user.role, "active": 1 if user.active else 0,
+                                  "location_id": user.location_id or ''})
+    userData['locations'] = [{"id": locationId, "name": st.location['location']['name']} for locationId, st in locations.items()]
     return render_template('admin_users.html', userData=userData)
 
 @app.route('/update-users', methods=['POST'])
@@ -498,6 +933,8 @@ def update_users():
     print('update-users')
     userData = request.get_json()
     print(userData)
+    if any(user.get('location_id') and user['location_id'] not in locations for user in userData['users']):
+        return 'Fail', 400
     for user in userData['users']:
         print('updating user: %s' % user['id'])
         userRecord = User.query.get(int(user['id']))
@@ -505,16 +942,14 @@ def update_users():
             userRecord.name = user['name']
             userRecord.role = user['role']
             userRecord.active = True if user['active'] == '1' else False
+            userRecord.location_id = user.get('location_id', userRecord.location_id)
             if user['reset'] == '1':
                 userRecord.password = ''
             db.session.commit()
-    if UserLogging.query.filter(UserLogging.event == 'user-update').filter(UserLogging.log_event == True).first():
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        current_user.logins.append(UserLogin(event='user-update', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+    forget_users()
+    if logging_enabled('user-update'):
+        ip = client_ip()
+        add_user_log(current_user.id, 'user-update', ip)
     return 'OK', 200
 
 @app.route('/new-user', methods=['POST'])
@@ -525,23 +960,23 @@ def new_user():
     print('new-user')
     userData = request.get_json()
     print(userData)
+    if userData.get('location_id') and userData['location_id'] not in locations:
+        return 'Fail', 400
     if not User.query.filter(User.email == userData['email']).first():
         user = User(
             active=True if userData['active'] == '1' else False,
             email=userData['email'],
             password='',
             name=userData['name'],
-            role=userData['role']
+            role=userData['role'],
+            location_id=userData.get('location_id', '')
         )
         db.session.add(user)
         db.session.commit()
-    if UserLogging.query.filter(UserLogging.event == 'user-update').filter(UserLogging.log_event == True).first():
-        if request.headers.getlist('X-Forwarded-For'):
-            ip = request.headers.getlist('X-Forwarded-For')[0]
-        else:
-            ip = request.remote_addr
-        current_user.logins.append(UserLogin(event='user-update', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-        db.session.commit()
+        forget_users(user.id)
+    if logging_enabled('user-update'):
+        ip = client_ip()
+        add_user_log(current_user.id, 'user-update', ip)
     return 'OK', 200
 
 # Admin Presence Sensor Config
@@ -550,6 +985,9 @@ def new_user():
 def config_presence():
     if current_user.role != 'Admin':
         return redirect(url_for('index'))
+    st = user_location()
+    if not st:
+        return 'Fail', 403
     configData = st.getPresence()
     return render_template('admin_presence.html', configData=configData)
 
@@ -560,17 +998,16 @@ def update_presence_configs():
         print('update-presence-configs')
         configData = request.get_json()
         print(configData)
+        st = user_location()
+        if not st:
+            return 'Fail', 403
+        previous = st.copyLocation()
         if st.updatePresenceConfigs(configData):
             st.readData(refresh=False)
-            location_data = json.dumps(st.location)
-            socketio.emit('location_data', location_data, room=st.location_id) #Broadcase any changes to all users.
-            if UserLogging.query.filter(UserLogging.event == 'presence-update').filter(UserLogging.log_event == True).first():
-                if request.headers.getlist('X-Forwarded-For'):
-                    ip = request.headers.getlist('X-Forwarded-For')[0]
-                else:
-                    ip = request.remote_addr
-                current_user.logins.append(UserLogin(event='presence-update', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-                db.session.commit()
+            broadcast_changes(st, previous) #Broadcast any changes to all users.
+            if logging_enabled('presence-update'):
+                ip = client_ip()
+                add_user_log(current_user.id, 'presence-update', ip)
             return 'OK', 200
         return 'Fail', 200
     return 'Fail', 403
@@ -581,6 +1018,9 @@ def update_presence_configs():
 def config_scenes():
     if current_user.role != 'Admin':
         return redirect(url_for('index'))
+    st = user_location()
+    if not st:
+        return 'Fail', 403
     configData = st.getScenes()
     return render_template('admin_scenes.html', configData=configData)
 
@@ -592,17 +1032,16 @@ def update_scene_configs():
         configData = request.get_json()
         print(configData)
         print('Scene items: %d' % len(configData['scenes']))
+        st = user_location()
+        if not st:
+            return 'Fail', 403
+        previous = st.copyLocation()
         if st.updateSceneConfigs(configData):
             st.readData(refresh=False)
-            location_data = json.dumps(st.location)
-            socketio.emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.
-            if UserLogging.query.filter(UserLogging.event == 'scene-update').filter(UserLogging.log_event == True).first():
-                if request.headers.getlist('X-Forwarded-For'):
-                    ip = request.headers.getlist('X-Forwarded-For')[0]
-                else:
-                    ip = request.remote_addr
-                current_user.logins.append(UserLogin(event='scene-update', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-                db.session.commit()
+            broadcast_changes(st, previous) #Broadcast any changes to all users.
+            if logging_enabled('scene-update'):
+                ip = client_ip()
+                add_user_log(current_user.id, 'scene-update', ip)
             return 'OK', 200
         return 'Fail', 200
     return 'Fail', 403
@@ -611,8 +1050,8 @@ def update_scene_configs():
 @app.route('/config-rooms')
 @login_required
 def config_rooms():
-    if current_user.role == 'Admin':
-        configData = st.getConfig()
+    if current_user.role == 'Admin' and user_location():
+        configData = user_location().getConfig()
         return render_template('admin_rooms.html', configData=configData)
     # If the user isn't an Admin, log them out, flash them a message, and send back to the login page.
     logout_user()
@@ -628,17 +1067,16 @@ def update_room_configs():
         configData = request.get_json()
         print(configData)
         print('Location items: %d' % len(configData['location']))
+        st = user_location()
+        if not st:
+            return 'Fail', 403
+        previous = st.copyLocation()
         if st.updateConfigs(configData):
             st.readData(refresh=False)
-            location_data = json.dumps(st.location)
-            socketio.emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.
-            if UserLogging.query.filter(UserLogging.event == 'config-update').filter(UserLogging.log_event == True).first():
-                if request.headers.getlist('X-Forwarded-For'):
-                    ip = request.headers.getlist('X-Forwarded-For')[0]
-                else:
-                    ip = request.remote_addr
-                current_user.logins.append(UserLogin(event='config-update', date=datetime.now().strftime('%m/%d/%y %H:%M:%S'), ip=ip))
-                db.session.commit()
+            broadcast_changes(st, previous) #Broadcast any changes to all users.
+            if logging_enabled('config-update'):
+                ip = client_ip()
+                add_user_log(current_user.id, 'config-update', ip)
             return 'OK', 200
         return 'Fail', 200
     return 'Fail', 403
@@ -649,10 +1087,13 @@ def update_room_configs():
 def admin_refresh_scenes():
     if current_user.role != 'Admin':
         return 'Fail', 403
+    st = user_location()
+    if not st:
+        return 'Fail', 403
+    previous = st.copyLocation()
     if st.loadAllScenes():
         if st.readAllScenes():
-            location_data = json.dumps(st.location)
-            socketio.emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.            
+            broadcast_changes(st, previous) #Broadcast any changes to all users.
             return 'OK', 200
     return 'Fail', 200
 
@@ -662,9 +1103,12 @@ def admin_refresh_scenes():
 def admin_refresh_device_status():
     if current_user.role != 'Admin':
         return 'Fail', 403
+    st = user_location()
+    if not st:
+        return 'Fail', 403
+    previous = st.copyLocation()
     if st.loadAllDevicesStatus():
-        location_data = json.dumps(st.location)
-        socketio.emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.            
+        broadcast_changes(st, previous) #Broadcast any changes to all users.
         return 'OK', 200
     return 'Fail', 200
 
@@ -674,9 +1118,12 @@ def admin_refresh_device_status():
 def admin_refresh_device_health():
     if current_user.role != 'Admin':
         return 'Fail', 403
+    st = user_location()
+    if not st:
+        return 'Fail', 403
+    previous = st.copyLocation()
     if st.loadAllDevicesHealth():
-        location_data = json.dumps(st.location)
-        socketio.emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.            
+        broadcast_changes(st, previous) #Broadcast any changes to all users.
         return 'OK', 200
     return 'Fail', 200
 
@@ -686,19 +1133,214 @@ def admin_refresh_device_health():
 def admin_refresh_foundation():
     if current_user.role != 'Admin':
         return 'Fail', 403
-    if st.loadData():
-        if st.readData(refresh=False):
-            location_data = json.dumps(st.location)
-            socketio.emit('location_data', location_data, room=st.location_id) #Broadcast any changes to all users.            
-            return 'OK', 200        
+    if user_location() and sync_foundation(user_location()):
+        return 'OK', 200
     return 'Fail', 200
 
+def background_refresh(st):
+    # Startup refresh of a location from the SmartThings API.  Runs in its own greenlet after we start serving and pushes
+    #   each step's changes to the browsers as it completes.
+    started = time.time()
+    if st.refreshData(changed=lambda previous: broadcast_changes(st, previous)):
+        print('Background refresh of %s complete in %.2fs' % (st.location_id, time.time() - started))
+    else:
+        print('Background refresh of %s finished with errors in %.2fs' % (st.location_id, time.time() - started))
+
+def start_location(st, index=0, count=1):
+    # Load a location and schedule its refreshes.  Every location refreshes in its own greenlets (with its own device
+    #   pool), so a large home doesn't hold up the others, and after their first foundation syncs the rest are spread over the interval.
+#    st.initialize(refresh=False) # Use this during development (after st.initialize() first) to eliminate API calls.
+    if BACKGROUND_REFRESH:
+        st.initialize(refresh=False)
+        eventlet.spawn(background_refresh, st)
+    else:
+        st.initialize()
+    if FOUNDATION_SYNC_INTERVAL:
+        eventlet.spawn(foundation_sync_loop, st, FOUNDATION_SYNC_INTERVAL * index // count, FOUNDATION_SYNC_DELAY * (index + 1))
+
+event_queue = LightQueue(EVENT_QUEUE_SIZE) # (time queued, locationId, events) from EVENT lifecycle requests.
+event_workers = []
+event_stats = {'queued': 0, 'processed': 0, 'dropped': 0, 'failed': 0, 'unrouted': 0, 'latency_last': 0.0, 'latency_max': 0.0, 'latency_total': 0.0}
+
+def enqueue_events(locationId, events):
+    # Queue a batch of webhook events (from the installedApp in locationId) for the workers.  Returns False if the queue
+    #   is full and the batch was dropped.
+    if not event_workers:
+        start_event_workers()
+    try:
+        event_queue.put_nowait((time.monotonic(), locationId, events))
+    except Full:
+        event_stats['dropped'] += 1
+        print('Event queue full, dropped %d event(s)' % len(events))
+        return False
+    event_stats['queued'] += 1
+    return True
+
+def start_event_workers():
+    for i in range(EVENT_WORKERS):
+        event_workers.append(eventlet.spawn(event_worker))
+
+def event_worker():
+    # Apply queued event batches and broadcast the results.  SmartThings can batch several events into one request,
+    #   so we apply them all and send one message per location.
+    while True:
+        queued, locationId, events = event_queue.get()
+        st = locations.get(locationId)
+        if st is None:
+            event_stats['unrouted'] += 1
+            print('Events for unknown location %s, dropped %d event(s)' % (locationId, len(events)))
+            continue
+        try:
+            for locationId, result in st.updateEvents(events).items():
+                emit_changes(locationId, throttle.filter(locationId, result['changes']))
+                if result['health']:
+                    emit_patches(st, st.publishHealthChanges(result['health']))
+            event_stats['processed'] += 1
+        except Exception as e:
+            event_stats['failed'] += 1
+            print('Event processing failed: %s' % e)
+        latency = time.monotonic() - queued
+        event_stats['latency_last'] = latency
+        event_stats['latency_max'] = max(event_stats['latency_max'], latency)
+        event_stats['latency_total'] += latency
+
+def confirm_webhook(confirmationURL):
+    # GET the CONFIRMATION lifecycle's URL to register our webhook.  No headers, this isn't a SmartThings API call.
+    try:
+        r = api.get(confirmationURL, headers={})
+        print('CONFIRMATION URL: %s Status: %s' % (confirmationURL, r.status_code))
+    except requests.exceptions.RequestException as e:
+        print('CONFIRMATION URL: %s Failed: %s' % (confirmationURL, e))
+
+def sync_foundation(st):
+    # Sync a location's details, app, rooms and devices from the API.  Only when one of them actually changed do we
+    #   rebuild st.location and broadcast the changes.
+    previous = st.copyLocation()
+    if not st.loadData():
+        return False
+    if st.foundationChanged():
+        if not st.readData(refresh=False):
+            return False
+        broadcast_changes(st, previous) #Broadcast any changes to all users.
+    return True
+
+def foundation_sync_loop(st, offset=0, delay=0):
+    # The first sync runs delay seconds in, the rest every FOUNDATION_SYNC_INTERVAL starting offset seconds after it.
+    eventlet.sleep(delay)
+    while True:
+        try:
+            if not sync_foundation(st):
+                print('Scheduled foundation sync of %s failed.' % st.location_id)
+        except Exception as e:
+            print('Scheduled foundation sync of %s failed: %s' % (st.location_id, e))
+        eventlet.sleep(offset + FOUNDATION_SYNC_INTERVAL)
+        offset = 0
+
+def delete_logs(model, condition):
+    # Delete the log rows matching condition in one statement, archiving them first if LOG_ARCHIVE_DIR is set.
+    #   Returns the number of rows deleted.  Nothing is deleted if the archive can't be written.
+    if LOG_ARCHIVE_DIR and not archive_logs(model, condition):
+        return 0
+    count = model.query.filter(condition).delete(synchronize_session=False)
+    db.session.commit()
+    return count
+
+def archive_logs(model, condition):
+    # Append the rows matching condition to <LOG_ARCHIVE_DIR>/<table>-<YYYY-MM>.jsonl.gz, one JSON object per line.
+    #   Each call adds a gzip member to the month's file, which gzip/zcat read as one stream.
+    columns = [column.name for column in model.__table__.columns]
+    path = os.path.join(LOG_ARCHIVE_DIR, '%s-%s.jsonl.gz' % (model.__tablename__, datetime.now().strftime('%Y-%m')))
+    try:
+        os.makedirs(LOG_ARCHIVE_DIR, exist_ok=True)
+        with gzip.open(path, 'at', encoding='utf-8') as archive:
+            for row in db.session.query(model.__table__).filter(condition).order_by(model.id).yield_per(1000):
+                archive.write(json.dumps(dict(zip(columns, row))) + '\n')
+    except (OSError, ValueError) as e:
+        print('Log archive to %s failed: %s' % (path, e))
+        return False
+    return True
+
+def prune_logs():
+    # Enforce LOG_RETENTION: drop rows older than the table's days, then all but its newest max rows (by id).
+    for model in (UserLogin, FailedLogin):
+        days, maxRows = LOG_RETENTION.get(model.__tablename__, (0, 0))
+        condition = db.false()
+        if days:
+            condition = condition | (model.date < (datetime.now() - timedelta(days=days)).strftime(LOG_DATE_FORMAT))
+        if maxRows:
+            boundary = db.session.query(model.id).order_by(model.id.desc()).offset(maxRows).limit(1).scalar()
+            if boundary is not None:
+                condition = condition | (model.id <= boundary)
+        count = delete_logs(model, condition)
+        if count:
+            print('Pruned %d %s record(s)' % (count, model.__tablename__))
+
+def log_prune_loop():
+    # Runs outside any request, so it has its own app context for db.session.
+    with app.app_context():
+        while True:
+            try:
+                prune_logs()
+            except Exception as e:
+                db.session.rollback()
+                print('Log prune failed: %s' % e)
+            eventlet.sleep(LOG_PRUNE_INTERVAL)
+
+def broadcast_changes(st, previous):
+    # Send every browser on the location a versioned patch of what changed in st.location since previous (a copy from
+    #   st.copyLocation()).
+    patches = st.publishChanges(previous)
+    if patches:
+        emit_patches(st, patches)
+
+def emit_patches(st, patches):
+    # Send each view's patch (from one of the st.publish methods) to the location's browsers on that view.
+    for view, patch in patches.items():
+        print('Emitting: location_patch (version %d) to room: %s' % (patch['version'], st.viewRoom(view)))
+        socketio.emit('location_patch', json.dumps(patch), room=st.viewRoom(view))
+
+def emit_changes(locationId, changes):
+    # Send device changes to the browsers as one versioned change.  A single change goes out as its own event,
+    #   several are coalesced into one device_batch.
+    #   Each view only gets the changes it can see, or an empty patch to keep its version current.
+    st = locations.get(locationId)
+    if not changes or st is None:
+        return
+    patches = st.publishDeviceChanges(changes)
+    for view, patch in patches.items():
+        room = st.viewRoom(view)
+        visible = [(event, data) for event, data in changes if st.canSee(view, data['deviceId'])]
+        if not visible:
+            socketio.emit('location_patch', json.dumps(patch), room=room)
+        elif len(visible) == 1:
+            event, data = visible[0]
+            print('Emitting: %s: %s to room: %s' % (event, data, room))
+            socketio.emit(event, json.dumps(dict(data, base=patch['base'], version=patch['version'])), room=room)
+        else:
+            print('Emitting: device_batch (%d changes) to room: %s' % (len(visible), room))
+            batch = {'base': patch['base'], 'version': patch['version'], 'changes': [{'event': event, 'data': data} for event, data in visible]}
+            socketio.emit('device_batch', json.dumps(batch), room=room)
+
+throttle = EventThrottle(emit_changes) # Holds back noisy sensors, see THROTTLE_WINDOWS in smartthings.py.  Shared by every location
+                                      #   (it's keyed by device, and held changes remember their location), so its stats are totals.
+
 # Only logged in users can see the dashboard.
 @app.route('/', methods=['GET'])
 @login_required
 def index():
     return render_template('dashboard.html')
 
+def served_location(locationId):
+    # The SmartThings for a location the app was just installed in (or updated).  If it's new to us it's loaded in the
+    #   background so SmartThings gets its answer right away.  None if LOCATIONS says we don't serve it.
+    if LOCATIONS and locationId not in LOCATIONS:
+        print('Not serving location %s' % locationId)
+        return None
+    if locationId not in locations:
+        st = add_location(locationId)
+        eventlet.spawn(start_location, st, len(locations) - 1, len(locations))
+    return locations[locationId]
+
 @app.route('/', methods=['POST'])
 def smarthings_requests():
     content = request.get_json()
@@ -711,13 +1353,11 @@ def smarthings_requests():
         return jsonify(data)
 
     elif (content['lifecycle'] == 'CONFIRMATION'):
+        # Visit the confirmation URL in the background so we can answer SmartThings right away.
         confirmationURL = content['confirmationData']['confirmationUrl']
-        r = requests.get(confirmationURL)
-        print('CONFIRMATION\nContent: %s\nURL: %s\nStatus: %s' % (content,confirmationURL,r.status_code))
-        if r.status_code == 200:
-            return r.text
-        else:
-            abort(r.status_code)
+        print('CONFIRMATION\nContent: %s\nURL: %s' % (content,confirmationURL))
+        eventlet.spawn(confirm_webhook, confirmationURL)
+        return jsonify({'targetUrl': request.url_root})
 
     elif (content['lifecycle'] == 'CONFIGURATION' and content['configurationData']['phase'] == 'INITIALIZE'):
         print(content['configurationData']['phase'])
@@ -796,21 +1436,9 @@ def smarthings_requests():
 
         if content['appId'] == ST_WEBHOOK:
             print('Installing ST Webhook')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'switch', 'switch', 'capSwitchSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'lock', 'lock', 'capLockSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'temperatureMeasurement', 'temperature', 'capTempSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'relativeHumidityMeasurement', 'humidity', 'capHumiditySubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'doorControl', 'door', 'capDoorSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'contactSensor', 'contact', 'capContactSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'motionSensor', 'motion', 'capMotionSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'switchLevel', 'level', 'capSwitchLevelSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'battery', 'battery', 'capBatterySubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'presenceSensor', 'presence', 'capPresenceSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatOperatingState', 'thermostatOperatingState', 'capOperatingStateSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatMode', 'thermostatMode', 'capModeSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatCoolingSetpoint', 'coolingSetpoint', 'capCoolSetpointSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatHeatingSetpoint', 'heatingSetpoint', 'capHeatSetpointSubscription')
-            st.deviceHealthSubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'])
+            st = served_location(resp['installedApp']['locationId'])
+            if st:
+                st.subscribeAll(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'])
         else:
             data = {'appId':'Not Recognized'}
             print('Install Unknown appId: %s' % content['appId'])
@@ -825,22 +1453,10 @@ def smarthings_requests():
 
         if content['appId'] == ST_WEBHOOK:
             print('Updating ST Webhook')
-            st.deleteSubscriptions(resp['authToken'], resp['installedApp']['installedAppId'])
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'switch', 'switch', 'capSwitchSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'lock', 'lock', 'capLockSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'temperatureMeasurement', 'temperature', 'capTempSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'relativeHumidityMeasurement', 'humidity', 'capHumiditySubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'doorControl', 'door', 'capDoorSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'contactSensor', 'contact', 'capContactSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'motionSensor', 'motion', 'capMotionSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'switchLevel', 'level', 'capSwitchLevelSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'battery', 'battery', 'capBatterySubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'presenceSensor', 'presence', 'capPresenceSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatOperatingState', 'thermostatOperatingState', 'capOperatingStateSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatMode', 'thermostatMode', 'capModeSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatCoolingSetpoint', 'coolingSetpoint', 'capCoolSetpointSubscription')
-            st.capabilitySubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'], 'thermostatHeatingSetpoint', 'heatingSetpoint', 'capHeatSetpointSubscription')
-            st.deviceHealthSubscriptions(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'])
+            st = served_location(resp['installedApp']['locationId'])
+            if st:
+                st.deleteSubscriptions(resp['authToken'], resp['installedApp']['installedAppId'])
+                st.subscribeAll(resp['authToken'], resp['installedApp']['locationId'], resp['installedApp']['installedAppId'])
         else:
             data = {'appId':'Not Recognized'}
             print('Update Unknown appId: %s' % content['appId'])
@@ -855,20 +1471,9 @@ def smarthings_requests():
     elif (content['lifecycle'] == 'EVENT'):
         data = {'eventData':{}}
 
-        event = content['eventData']['events'][0]
-
         if content['appId'] == ST_WEBHOOK:
-            if event['eventType'] == 'DEVICE_EVENT':
-                device = event['deviceEvent']
-                emit_val = st.updateDevice(device['deviceId'], device['capability'], device['attribute'], device['value'])
-                if emit_val:
-                    print('emit_val: ', emit_val)
-                    print('Emitting: %s: %s to room: %s' % (emit_val[0], emit_val[1], device['locationId']))
-                    socketio.emit(emit_val[0],emit_val[1], room=device['locationId'])
-            elif event['eventType'] == 'DEVICE_HEALTH_EVENT':
-                data = event['deviceHealthEvent']
-                if st.updateDeviceHealth(data['deviceId'], data['status']):
-                    socketio.emit('location-data', json.dumps(st.location), room=data['locationId'])
+            # Acknowledge now, the event workers apply and broadcast the events.
+            enqueue_events(content['eventData']['installedApp']['locationId'], content['eventData']['events'])
         else:
             data = {'appId':'Not Recognized'}
             print('Event Unknown appId: %s' % content['appId'])
@@ -900,7 +1505,24 @@ def favicon():
     return send_from_directory('/home/pi/static', 'favicon.png')
 
 if __name__ == '__main__':
-    st = SmartThings()
-#    st.initialize(refresh=False) # Use this during development (after st.initialize() first) to eliminate API calls.
-    st.initialize()
-    socketio.run(app, debug=True, host='0.0.0.0', port=5000)
+    startup['started'] = time.time()
+    if HISTORY:
+        history_store = HistoryStore()
+        history_store.startPruning()
+    for locationId in LOCATIONS or installedLocations(api):
+        add_location(locationId)
+    if not locations:
+        print('No locations to serve!')
+    for position, location in enumerate(list(locations.values())):
+        start_location(location, position, len(locations))
+    if LOG_PRUNE_INTERVAL:
+        eventlet.spawn(log_prune_loop)
+    print('Startup ready to serve in %.2fs' % (time.time() - startup['started']))
+    try:
+        socketio.run(app, debug=True, host='0.0.0.0', port=5000)
+    finally:
+        for location in locations.values():
+            location.close()
+        database.close()
+        if history_store:
+            history_store.close()